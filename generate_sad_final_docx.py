@@ -4,12 +4,27 @@
 from __future__ import annotations
 
 import datetime as _dt
+import contextlib
 import copy
+import functools
+import hashlib
+import io
+import json
+import math
 import re
+import resource
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
 import zipfile
+import zlib
 import argparse
+from dataclasses import dataclass
 from pathlib import Path
-from typing import Final
+from typing import Final, Iterator
 import xml.etree.ElementTree as ET
 
 from PIL import Image, ImageDraw, ImageFont
@@ -31,6 +46,40 @@ DEFAULT_IMAGE_DPI: Final = 96
 
 FIGURE_MARKER_PREFIX: Final = "[FIG:"
 
+# Template parts the generator may rewrite. Everything else is copied into the output
+# with its compressed bytes untouched (no inflate/deflate round trip).
+EDITABLE_PARTS: Final = (
+    "[Content_Types].xml",
+    "word/document.xml",
+    "word/_rels/document.xml.rels",
+    "word/settings.xml",
+    "word/styles.xml",
+    "word/header1.xml",
+    "word/footer2.xml",
+)
+
+# Already-compressed payloads are candidates for ZIP_STORED. They are only stored when a trial
+# deflate saves less than MIN_DEFLATE_SAVING: the Mermaid PNGs still shrink by 5-15%. The trial
+# only deflates the first DEFLATE_SAMPLE_BYTES, so deciding costs little next to the real write.
+STORED_EXTENSIONS: Final = (".png", ".jpg", ".jpeg", ".gif", ".pdf", ".zip")
+MIN_DEFLATE_SAVING: Final = 0.02
+DEFLATE_SAMPLE_BYTES: Final = 64 * 1024
+
+
+def _zip_compress_type(name: str, data: bytes, compresslevel: int | None = None) -> int:
+    if not name.lower().endswith(STORED_EXTENSIONS) or not data:
+        return zipfile.ZIP_DEFLATED
+    sample = data[:DEFLATE_SAMPLE_BYTES]
+    deflated = len(zlib.compress(sample, -1 if compresslevel is None else compresslevel))
+    return zipfile.ZIP_STORED if deflated > len(sample) * (1 - MIN_DEFLATE_SAVING) else zipfile.ZIP_DEFLATED
+
+
+def _zip_member_size(name: str, data: bytes) -> int:
+    # What `data` will cost inside the DOCX, following _zip_compress_type.
+    if _zip_compress_type(name, data) == zipfile.ZIP_STORED:
+        return len(data)
+    return len(zlib.compress(data))
+
 # Make XML output use stable, conventional prefixes (LibreOffice is sometimes picky).
 ET.register_namespace("w", W_NS)
 ET.register_namespace("wp", WP_NS)
@@ -278,9 +327,34 @@ def sanitize_text(text: str) -> str:
     return text.strip()
 
 
-def _add_rtl_props(parent: ET.Element, bold: bool = False, italic: bool = False, color: str | None = None) -> None:
-    rPr = ET.SubElement(parent, _qn("w:rPr"))
-    ET.SubElement(rPr, _qn("w:rFonts"), {_qn("w:cs"): "B Nazanin"})
+# Custom styles registered in word/styles.xml by --styles. Generated content then refers to them
+# by ID instead of repeating the same direct formatting on every paragraph, run and table.
+BODY_PARA_STYLE: Final = "MPBody"
+CELL_PARA_STYLE: Final = "MPTableCell"
+RUN_CHAR_STYLE: Final = "MPRun"
+TABLE_STYLE: Final = "MPTable"
+
+_use_styles = False
+
+
+def set_style_mode(enabled: bool) -> None:
+    """
+    Switch make_p/make_tbl/_add_rtl_props between inline direct formatting (default) and
+    references to the custom styles; the latter requires register_generated_styles() on the output.
+    """
+    global _use_styles
+    _use_styles = enabled
+
+
+# Property subtrees (w:rPr / w:pPr) repeat for every paragraph and table cell, so each distinct
+# combination is built once and deep-copied (a single C-level call) instead of rebuilt node by node.
+@functools.lru_cache(maxsize=None)
+def _rtl_props_template(bold: bool, italic: bool, color: str | None, styled: bool = False) -> ET.Element:
+    rPr = ET.Element(_qn("w:rPr"))
+    if styled:
+        ET.SubElement(rPr, _qn("w:rStyle"), {_qn("w:val"): RUN_CHAR_STYLE})
+    else:
+        ET.SubElement(rPr, _qn("w:rFonts"), {_qn("w:cs"): "B Nazanin"})
     if bold:
         ET.SubElement(rPr, _qn("w:b"))
         ET.SubElement(rPr, _qn("w:bCs"))
@@ -289,24 +363,34 @@ def _add_rtl_props(parent: ET.Element, bold: bool = False, italic: bool = False,
         ET.SubElement(rPr, _qn("w:iCs"))
     if color:
         ET.SubElement(rPr, _qn("w:color"), {_qn("w:val"): color})
-    ET.SubElement(rPr, _qn("w:rtl"))
-    ET.SubElement(rPr, _qn("w:lang"), {_qn("w:bidi"): "fa-IR"})
+    if not styled:
+        ET.SubElement(rPr, _qn("w:rtl"))
+        ET.SubElement(rPr, _qn("w:lang"), {_qn("w:bidi"): "fa-IR"})
+    return rPr
 
 
-def make_p(
-    text: str = "",
-    *,
-    style: str | None = None,
-    bold: bool = False,
-    italic: bool = False,
-    jc: str = "lowKashida",
-    color: str | None = None,
-    spacing_before: int = 100,
-    spacing_after: int = 100,
-    keep_next: bool = False,
+def _add_rtl_props(parent: ET.Element, bold: bool = False, italic: bool = False, color: str | None = None) -> None:
+    parent.append(copy.deepcopy(_rtl_props_template(bold, italic, color, _use_styles)))
+
+
+@functools.lru_cache(maxsize=None)
+def _p_props_template(
+    style: str | None, jc: str, spacing_before: int, spacing_after: int, keep_next: bool, styled: bool = False
 ) -> ET.Element:
-    p = ET.Element(_qn("w:p"))
-    pPr = ET.SubElement(p, _qn("w:pPr"))
+    pPr = ET.Element(_qn("w:pPr"))
+    if styled and not style:
+        # Body paragraphs: MPBody carries spacing/line/jc and the RTL mark formatting,
+        # so only the deviations from it are written inline.
+        ET.SubElement(pPr, _qn("w:pStyle"), {_qn("w:val"): BODY_PARA_STYLE})
+        if keep_next:
+            ET.SubElement(pPr, _qn("w:keepNext"))
+        if (spacing_before, spacing_after) != (100, 100):
+            ET.SubElement(
+                pPr, _qn("w:spacing"), {_qn("w:before"): str(spacing_before), _qn("w:after"): str(spacing_after)}
+            )
+        if jc != "lowKashida":
+            ET.SubElement(pPr, _qn("w:jc"), {_qn("w:val"): jc})
+        return pPr
     if style:
         ET.SubElement(pPr, _qn("w:pStyle"), {_qn("w:val"): style})
     ET.SubElement(
@@ -324,7 +408,24 @@ def make_p(
     if keep_next:
         ET.SubElement(pPr, _qn("w:keepNext"))
     ET.SubElement(pPr, _qn("w:jc"), {_qn("w:val"): jc})
-    _add_rtl_props(pPr, bold=False, italic=False)
+    pPr.append(copy.deepcopy(_rtl_props_template(False, False, None, styled)))
+    return pPr
+
+
+def make_p(
+    text: str = "",
+    *,
+    style: str | None = None,
+    bold: bool = False,
+    italic: bool = False,
+    jc: str = "lowKashida",
+    color: str | None = None,
+    spacing_before: int = 100,
+    spacing_after: int = 100,
+    keep_next: bool = False,
+) -> ET.Element:
+    p = ET.Element(_qn("w:p"))
+    p.append(copy.deepcopy(_p_props_template(style, jc, spacing_before, spacing_after, keep_next, _use_styles)))
 
     if text:
         r = ET.SubElement(p, _qn("w:r"))
@@ -341,20 +442,33 @@ def make_label(text: str) -> ET.Element:
     return make_p(text, bold=True, spacing_before=200, spacing_after=80, keep_next=True)
 
 
-def make_tbl(headers: list[str], rows: list[list[str]], *, col_weights: list[int] | None = None) -> ET.Element:
-    tbl = ET.Element(_qn("w:tbl"))
+@functools.lru_cache(maxsize=None)
+def _cell_p_props_template(styled: bool = False) -> ET.Element:
+    # Table rows are prone to spilling across pages in Word/LibreOffice when
+    # paragraph spacing is large. Use compact spacing inside table cells.
+    pPr = ET.Element(_qn("w:pPr"))
+    if styled:
+        ET.SubElement(pPr, _qn("w:pStyle"), {_qn("w:val"): CELL_PARA_STYLE})
+        return pPr
+    ET.SubElement(
+        pPr,
+        _qn("w:spacing"),
+        {
+            _qn("w:before"): "0",
+            _qn("w:after"): "0",
+            _qn("w:line"): "240",
+            _qn("w:lineRule"): "auto",
+        },
+    )
+    ET.SubElement(pPr, _qn("w:jc"), {_qn("w:val"): "center"})
+    pPr.append(copy.deepcopy(_rtl_props_template(False, False, None)))
+    return pPr
 
-    tblPr = ET.SubElement(tbl, _qn("w:tblPr"))
-    ET.SubElement(tblPr, _qn("w:tblStyle"), {_qn("w:val"): "TableGrid"})
-    ET.SubElement(tblPr, _qn("w:bidiVisual"))
-    total_w = 8530  # dxa; matches template's main tables
-    ET.SubElement(tblPr, _qn("w:tblW"), {_qn("w:w"): str(total_w), _qn("w:type"): "dxa"})
-    ET.SubElement(tblPr, _qn("w:jc"), {_qn("w:val"): "center"})
+
+def _tbl_margins_and_borders(tblPr: ET.Element) -> None:
     cell_mar = ET.SubElement(tblPr, _qn("w:tblCellMar"))
-    ET.SubElement(cell_mar, _qn("w:left"), {_qn("w:w"): "0", _qn("w:type"): "dxa"})
-    ET.SubElement(cell_mar, _qn("w:right"), {_qn("w:w"): "0", _qn("w:type"): "dxa"})
-    ET.SubElement(cell_mar, _qn("w:top"), {_qn("w:w"): "0", _qn("w:type"): "dxa"})
-    ET.SubElement(cell_mar, _qn("w:bottom"), {_qn("w:w"): "0", _qn("w:type"): "dxa"})
+    for side in ("left", "right", "top", "bottom"):
+        ET.SubElement(cell_mar, _qn(f"w:{side}"), {_qn("w:w"): "0", _qn("w:type"): "dxa"})
     borders = ET.SubElement(tblPr, _qn("w:tblBorders"))
     for side in ("top", "left", "bottom", "right", "insideH", "insideV"):
         ET.SubElement(
@@ -369,6 +483,20 @@ def make_tbl(headers: list[str], rows: list[list[str]], *, col_weights: list[int
                 _qn("w:themeTint"): "99",
             },
         )
+
+
+def make_tbl(headers: list[str], rows: list[list[str]], *, col_weights: list[int] | None = None) -> ET.Element:
+    tbl = ET.Element(_qn("w:tbl"))
+
+    tblPr = ET.SubElement(tbl, _qn("w:tblPr"))
+    ET.SubElement(tblPr, _qn("w:tblStyle"), {_qn("w:val"): TABLE_STYLE if _use_styles else "TableGrid"})
+    ET.SubElement(tblPr, _qn("w:bidiVisual"))
+    total_w = 8530  # dxa; matches template's main tables
+    ET.SubElement(tblPr, _qn("w:tblW"), {_qn("w:w"): str(total_w), _qn("w:type"): "dxa"})
+    ET.SubElement(tblPr, _qn("w:jc"), {_qn("w:val"): "center"})
+    if not _use_styles:
+        # MPTable carries the cell margins and borders in styled mode.
+        _tbl_margins_and_borders(tblPr)
     ET.SubElement(
         tblPr,
         _qn("w:tblLook"),
@@ -395,22 +523,8 @@ def make_tbl(headers: list[str], rows: list[list[str]], *, col_weights: list[int
     widths[-1] += drift
 
     def _cell_p(text: str, *, bold: bool) -> ET.Element:
-        # Table rows are prone to spilling across pages in Word/LibreOffice when
-        # paragraph spacing is large. Use compact spacing inside table cells.
         p = ET.Element(_qn("w:p"))
-        pPr = ET.SubElement(p, _qn("w:pPr"))
-        ET.SubElement(
-            pPr,
-            _qn("w:spacing"),
-            {
-                _qn("w:before"): "0",
-                _qn("w:after"): "0",
-                _qn("w:line"): "240",
-                _qn("w:lineRule"): "auto",
-            },
-        )
-        ET.SubElement(pPr, _qn("w:jc"), {_qn("w:val"): "center"})
-        _add_rtl_props(pPr, bold=False, italic=False)
+        p.append(copy.deepcopy(_cell_p_props_template(_use_styles)))
 
         r = ET.SubElement(p, _qn("w:r"))
         _add_rtl_props(r, bold=bold, italic=False, color=None)
@@ -462,6 +576,56 @@ def make_tbl(headers: list[str], rows: list[list[str]], *, col_weights: list[int
     return tbl
 
 
+def _generated_style_defs() -> list[ET.Element]:
+    # Built from the same templates as the inline output, so both modes render alike.
+    def style(kind: str, style_id: str, name: str, based_on: str) -> ET.Element:
+        el = ET.Element(_qn("w:style"), {_qn("w:type"): kind, _qn("w:customStyle"): "1", _qn("w:styleId"): style_id})
+        ET.SubElement(el, _qn("w:name"), {_qn("w:val"): name})
+        ET.SubElement(el, _qn("w:basedOn"), {_qn("w:val"): based_on})
+        return el
+
+    def para(style_id: str, name: str, pPr: ET.Element) -> ET.Element:
+        el = style("paragraph", style_id, name, "Normal")
+        pPr = copy.deepcopy(pPr)
+        mark = pPr.find("w:rPr", NS)
+        pPr.remove(mark)
+        el.append(pPr)
+        el.append(mark)
+        return el
+
+    body = para(BODY_PARA_STYLE, "MP Body", _p_props_template(None, "lowKashida", 100, 100, False))
+    cell = para(CELL_PARA_STYLE, "MP Table Cell", _cell_p_props_template())
+
+    run = style("character", RUN_CHAR_STYLE, "MP Run", "DefaultParagraphFont")
+    run.append(copy.deepcopy(_rtl_props_template(False, False, None)))
+
+    table = style("table", TABLE_STYLE, "MP Table", "TableGrid")
+    _tbl_margins_and_borders(ET.SubElement(table, _qn("w:tblPr")))
+    return [body, cell, run, table]
+
+
+def register_generated_styles(file_bytes: dict[str, bytes]) -> None:
+    """
+    Add the MP* styles used by --styles to word/styles.xml (once; existing IDs are left alone).
+    Inserted as text before </w:styles> so the template's namespace prefixes and mc:Ignorable
+    list survive untouched.
+    """
+    styles_xml = file_bytes.get("word/styles.xml")
+    if styles_xml is None:
+        raise SystemExit("Template missing word/styles.xml")
+    text = styles_xml.decode("utf-8")
+    end = text.rfind("</w:styles>")
+    if end < 0:
+        raise SystemExit("Unexpected word/styles.xml (no </w:styles>)")
+    new_defs = [
+        ET.tostring(el, encoding="unicode")
+        for el in _generated_style_defs()
+        if f'w:styleId="{el.get(_qn("w:styleId"))}"' not in text
+    ]
+    if new_defs:
+        file_bytes["word/styles.xml"] = (text[:end] + "".join(new_defs) + text[end:]).encode("utf-8")
+
+
 def _simple_box_diagram(
     path: Path,
     *,
@@ -498,6 +662,28 @@ def _simple_box_diagram(
     img.save(path, format="PNG")
 
 
+# Figure ID -> expected filename under diagrams/ (a "-vp" sibling is preferred when present).
+FIGURE_FILES: Final = {
+    "2-1": "fig-2-1-context.png",
+    "2-2": "fig-2-2-container.png",
+    "2-3": "fig-2-3-component.png",
+    "4-1": "fig-4-1-usecase.png",
+    "4-2": "fig-4-2-uc01-cache-hit.png",
+    "4-3": "fig-4-3-uc01-cache-miss.png",
+    "4-4": "fig-4-4-activity-uc01.png",
+    "4-5": "fig-4-5-uc02-start-pay.png",
+    "4-6": "fig-4-6-uc02-callback-verify.png",
+    "4-7": "fig-4-7-uc02-issue-notify.png",
+    "4-8": "fig-4-8-activity-uc02.png",
+    "4-9": "fig-4-9-state-booking.png",
+    "5-1": "fig-5-1-class-analytical.png",
+    "5-2": "fig-5-2-class-design.png",
+    "5-3": "fig-5-3-crc-common.png",
+    "7-1": "fig-7-1-deploy.png",
+    "9-1": "fig-9-1-erd.png",
+}
+
+
 def ensure_default_diagrams(diagrams_dir: Path) -> dict[str, Path]:
     """
     Ensures a set of simple placeholder diagrams exist under diagrams/.
@@ -506,25 +692,7 @@ def ensure_default_diagrams(diagrams_dir: Path) -> dict[str, Path]:
     """
     _ensure_dir(diagrams_dir)
 
-    fig_paths: dict[str, Path] = {
-        "2-1": diagrams_dir / "fig-2-1-context.png",
-        "2-2": diagrams_dir / "fig-2-2-container.png",
-        "2-3": diagrams_dir / "fig-2-3-component.png",
-        "4-1": diagrams_dir / "fig-4-1-usecase.png",
-        "4-2": diagrams_dir / "fig-4-2-uc01-cache-hit.png",
-        "4-3": diagrams_dir / "fig-4-3-uc01-cache-miss.png",
-        "4-4": diagrams_dir / "fig-4-4-activity-uc01.png",
-        "4-5": diagrams_dir / "fig-4-5-uc02-start-pay.png",
-        "4-6": diagrams_dir / "fig-4-6-uc02-callback-verify.png",
-        "4-7": diagrams_dir / "fig-4-7-uc02-issue-notify.png",
-        "4-8": diagrams_dir / "fig-4-8-activity-uc02.png",
-        "4-9": diagrams_dir / "fig-4-9-state-booking.png",
-        "5-1": diagrams_dir / "fig-5-1-class-analytical.png",
-        "5-2": diagrams_dir / "fig-5-2-class-design.png",
-        "5-3": diagrams_dir / "fig-5-3-crc-common.png",
-        "7-1": diagrams_dir / "fig-7-1-deploy.png",
-        "9-1": diagrams_dir / "fig-9-1-erd.png",
-    }
+    fig_paths: dict[str, Path] = {fig_id: diagrams_dir / name for fig_id, name in FIGURE_FILES.items()}
 
     if not fig_paths["2-1"].exists():
         _simple_box_diagram(
@@ -620,6 +788,120 @@ def ensure_default_diagrams(diagrams_dir: Path) -> dict[str, Path]:
     return fig_paths
 
 
+_PNG_SIGNATURE: Final = b"\x89PNG\r\n\x1a\n"
+
+
+def _probe_png(data: bytes) -> tuple[int, int, float | None] | None:
+    if not data.startswith(_PNG_SIGNATURE) or data[12:16] != b"IHDR":
+        return None
+    width, height = struct.unpack(">II", data[16:24])
+    dpi: float | None = None
+    pos = 8
+    # pHYs must precede the first IDAT, so stop there instead of walking the whole file.
+    while pos + 8 <= len(data):
+        length, ctype = struct.unpack(">I4s", data[pos : pos + 8])
+        if ctype == b"pHYs" and length == 9:
+            ppu_x, _ppu_y, unit = struct.unpack(">IIB", data[pos + 8 : pos + 17])
+            if unit == 1 and ppu_x:  # pixels per metre
+                dpi = ppu_x * 0.0254
+            break
+        if ctype in (b"IDAT", b"IEND"):
+            break
+        pos += 12 + length
+    return width, height, dpi
+
+
+def _probe_jpeg(data: bytes) -> tuple[int, int, float | None] | None:
+    if not data.startswith(b"\xff\xd8"):
+        return None
+    dpi: float | None = None
+    pos = 2
+    while pos + 4 <= len(data):
+        if data[pos] != 0xFF:
+            return None
+        marker = data[pos + 1]
+        if marker == 0xFF:  # fill byte
+            pos += 1
+            continue
+        seg_len = struct.unpack(">H", data[pos + 2 : pos + 4])[0]
+        seg = data[pos + 4 : pos + 2 + seg_len]
+        if marker == 0xE0 and seg.startswith(b"JFIF\x00") and len(seg) >= 12:
+            units, x_density = seg[7], struct.unpack(">H", seg[8:10])[0]
+            if x_density and units == 1:
+                dpi = float(x_density)
+            elif x_density and units == 2:  # dots per cm
+                dpi = x_density * 2.54
+        elif 0xC0 <= marker <= 0xCF and marker not in (0xC4, 0xC8, 0xCC) and len(seg) >= 5:
+            height, width = struct.unpack(">HH", seg[1:5])
+            return width, height, dpi
+        pos += 2 + seg_len
+    return None
+
+
+def probe_image(data: bytes) -> tuple[int, int, float | None]:
+    """
+    Return (width, height, dpi) from the PNG/JPEG headers in `data`; dpi is None when the file
+    doesn't declare one. Falls back to PIL (header-only open) for other formats.
+    """
+    info = _probe_png(data) or _probe_jpeg(data)
+    if info is not None:
+        return info
+    with Image.open(io.BytesIO(data)) as im:
+        dpi = im.info.get("dpi")
+        return im.size[0], im.size[1], float(dpi[0]) if dpi and dpi[0] else None
+
+
+@dataclass(frozen=True)
+class FigureInfo:
+    fig_id: str
+    path: Path
+    is_vp: bool
+    width: int
+    height: int
+    dpi: float | None
+    sha256: str
+    data: bytes
+
+
+def _pick_diagram_path(base_path: Path) -> Path | None:
+    vp_path = base_path.with_name(f"{base_path.stem}-vp{base_path.suffix}")
+    if vp_path.exists():
+        return vp_path
+    if base_path.exists():
+        return base_path
+    return None
+
+
+def build_figure_registry(diagrams_dir: Path, *, autogen: bool = True) -> dict[str, FigureInfo]:
+    """
+    Resolve every figure ID to the file that will be embedded, once per build.
+    Placeholders are generated first (if autogen), then each file is read a single time to get
+    its bytes, pixel size/DPI (from the headers) and content hash. Figures with no file on disk
+    are left out.
+    """
+    if autogen:
+        ensure_default_diagrams(diagrams_dir)
+
+    registry: dict[str, FigureInfo] = {}
+    for fig_id, name in FIGURE_FILES.items():
+        path = _pick_diagram_path(diagrams_dir / name)
+        if path is None:
+            continue
+        data = path.read_bytes()
+        width, height, dpi = probe_image(data)
+        registry[fig_id] = FigureInfo(
+            fig_id=fig_id,
+            path=path,
+            is_vp=path.stem.endswith("-vp"),
+            width=width,
+            height=height,
+            dpi=dpi,
+            sha256=hashlib.sha256(data).hexdigest(),
+            data=data,
+        )
+    return registry
+
+
 def _ensure_png_content_type(file_bytes: dict[str, bytes]) -> None:
     ct_xml = file_bytes.get("[Content_Types].xml")
     if ct_xml is None:
@@ -641,10 +923,7 @@ def _ensure_document_rels(file_bytes: dict[str, bytes]) -> ET.Element:
     rels_xml = file_bytes.get(rels_path)
     if rels_xml is None:
         root = ET.Element(_qns(REL_NS, "Relationships"))
-        xml = ET.tostring(root, encoding="utf-8", xml_declaration=True).decode("utf-8", errors="replace")
-        xml = re.sub(r"<(/?)rel:", r"<\1", xml)
-        xml = xml.replace(f'xmlns:rel=\"{REL_NS}\"', f'xmlns=\"{REL_NS}\"')
-        file_bytes[rels_path] = xml.encode("utf-8")
+        file_bytes[rels_path] = _rels_xml_bytes(root)
         return root
     return ET.fromstring(rels_xml)
 
@@ -675,7 +954,7 @@ def _add_image_relationship(rels_root: ET.Element, target: str) -> str:
     return rid
 
 
-def _px_to_emu(px: int, dpi: int = DEFAULT_IMAGE_DPI) -> int:
+def _px_to_emu(px: int, dpi: float = DEFAULT_IMAGE_DPI) -> int:
     return int(px / dpi * EMU_PER_INCH)
 
 
@@ -768,6 +1047,98 @@ def _max_docpr_id(doc_root: ET.Element) -> int:
     return max_id
 
 
+# Resampling only pays off when it drops a good share of the pixels; a few percent narrower image
+# re-encoded from LANCZOS output is usually *larger* than the renderer's optimized original.
+RESAMPLE_MAX_WIDTH_RATIO: Final = 0.8
+
+
+def _encode_resampled_png(im: Image.Image, *, dpi: int) -> bytes:
+    # Same idea as the renderer's encode_png "max" profile with quantize="auto": optimize, drop an
+    # unused alpha channel, and use an exact (lossless) palette when the image has <= 256 colours.
+    if im.mode in ("RGBA", "LA") and im.getchannel("A").getextrema() == (255, 255):
+        im = im.convert("RGB" if im.mode == "RGBA" else "L")
+    candidates = [im]
+    if im.mode == "RGB":
+        colors = im.getcolors(256)
+        if colors is not None:
+            candidates.append(im.quantize(colors=len(colors), dither=Image.Dither.NONE))
+    best = b""
+    for cand in candidates:
+        buf = io.BytesIO()
+        cand.save(buf, format="PNG", optimize=True, dpi=(dpi, dpi))
+        if not best or buf.tell() < len(best):
+            best = buf.getvalue()
+    return best
+
+
+def _resample_for_print(fig: FigureInfo, cx: int, *, dpi: int, cache_dir: Path) -> tuple[bytes, int, int]:
+    """
+    Downscale `fig` to the pixel width needed to print its final extent (cx EMU) at `dpi`.
+    Returns (png_bytes, width, height). The original comes back as-is when it is already small
+    enough, when the reduction is too small to matter, or when the resampled PNG isn't smaller once
+    zipped (the originals still deflate by 5-15%, optimized resampled PNGs barely at all).
+    Results are cached under cache_dir keyed by source hash and target size (an empty file
+    records "keep the original").
+    """
+    target_w = max(1, math.ceil(cx / EMU_PER_INCH * dpi))
+    if target_w > fig.width * RESAMPLE_MAX_WIDTH_RATIO:
+        return fig.data, fig.width, fig.height
+    target_h = max(1, round(fig.height * target_w / fig.width))
+
+    # "-z": decided on zipped sizes; entries decided on raw PNG sizes are not reused.
+    cached = cache_dir / f"{fig.sha256[:16]}-{target_w}x{target_h}-z.png"
+    if cached.exists():
+        data = cached.read_bytes()
+        return (data, target_w, target_h) if data else (fig.data, fig.width, fig.height)
+
+    with Image.open(io.BytesIO(fig.data)) as im:
+        if im.mode not in ("RGB", "RGBA", "L", "LA"):
+            im = im.convert("RGBA" if "transparency" in im.info else "RGB")
+        small = im.resize((target_w, target_h), Image.Resampling.LANCZOS)
+    data = _encode_resampled_png(small, dpi=dpi)
+    keep_original = _zip_member_size("resampled.png", data) >= _zip_member_size("original.png", fig.data)
+
+    _ensure_dir(cache_dir)
+    tmp = cached.with_suffix(".tmp")
+    tmp.write_bytes(b"" if keep_original else data)
+    tmp.replace(cached)
+    if keep_original:
+        return fig.data, fig.width, fig.height
+    return data, target_w, target_h
+
+
+def _place_figure(fig: FigureInfo, *, print_dpi: int | None, cache_dir: Path) -> tuple[bytes, str, int, int]:
+    """
+    Work out what gets embedded for `fig`: (media bytes, content-addressed media key, cx, cy in EMU).
+    """
+    # Honour the file's own resolution (PNG pHYs / JFIF density) when it declares one.
+    dpi = fig.dpi or DEFAULT_IMAGE_DPI
+    cx = _px_to_emu(fig.width, dpi)
+    cy = _px_to_emu(fig.height, dpi)
+    # Fit to page width (roughly): cap width to ~6.5 inches.
+    max_cx = int(6.5 * EMU_PER_INCH)
+    if cx > max_cx:
+        scale = max_cx / max(cx, 1)
+        cx = int(cx * scale)
+        cy = int(cy * scale)
+
+    data = fig.data
+    media_key = fig.sha256[:16]
+    if print_dpi is not None:
+        data, w, h = _resample_for_print(fig, cx, dpi=print_dpi, cache_dir=cache_dir)
+        if data is not fig.data:
+            media_key += f"-{w}x{h}"
+    return data, media_key, cx, cy
+
+
+def _rels_xml_bytes(rels_root: ET.Element) -> bytes:
+    xml = ET.tostring(rels_root, encoding="utf-8", xml_declaration=True).decode("utf-8", errors="replace")
+    # LibreOffice is more compatible with default-namespace (no prefix) relationship parts.
+    xml = re.sub(r"<(/?)rel:", r"<\1", xml)
+    xml = xml.replace(f'xmlns:rel=\"{REL_NS}\"', f'xmlns=\"{REL_NS}\"')
+    return xml.encode("utf-8")
+
+
 def embed_figures(
     root: ET.Element,
     file_bytes: dict[str, bytes],
@@ -775,66 +1146,46 @@ def embed_figures(
     diagrams_dir: Path,
     autogen: bool = True,
     embed_images: bool = True,
-) -> None:
+    registry: dict[str, FigureInfo] | None = None,
+    print_dpi: int | None = None,
+) -> dict[str, dict]:
     """
     Replaces marker paragraphs like [FIG:2-1] with embedded images from diagrams/.
     If embed_images is False, marker paragraphs are removed (captions remain).
+    Pass a prebuilt `registry` to reuse one figure scan across build steps.
+    With print_dpi, images larger than needed for their final size at that DPI are downscaled.
+    Returns figure ID -> {"rid", "part", "cx", "cy"} for every embedded figure.
     """
-    if autogen:
-        ensure_default_diagrams(diagrams_dir)
-
-    # Always map figure IDs to the expected filenames (so replacing later is stable).
-    expected = ensure_default_diagrams(diagrams_dir) if autogen else {
-        "2-1": diagrams_dir / "fig-2-1-context.png",
-        "2-2": diagrams_dir / "fig-2-2-container.png",
-        "2-3": diagrams_dir / "fig-2-3-component.png",
-        "4-1": diagrams_dir / "fig-4-1-usecase.png",
-        "4-2": diagrams_dir / "fig-4-2-uc01-cache-hit.png",
-        "4-3": diagrams_dir / "fig-4-3-uc01-cache-miss.png",
-        "4-4": diagrams_dir / "fig-4-4-activity-uc01.png",
-        "4-5": diagrams_dir / "fig-4-5-uc02-start-pay.png",
-        "4-6": diagrams_dir / "fig-4-6-uc02-callback-verify.png",
-        "4-7": diagrams_dir / "fig-4-7-uc02-issue-notify.png",
-        "4-8": diagrams_dir / "fig-4-8-activity-uc02.png",
-        "4-9": diagrams_dir / "fig-4-9-state-booking.png",
-        "5-1": diagrams_dir / "fig-5-1-class-analytical.png",
-        "5-2": diagrams_dir / "fig-5-2-class-design.png",
-        "5-3": diagrams_dir / "fig-5-3-crc-common.png",
-        "7-1": diagrams_dir / "fig-7-1-deploy.png",
-        "9-1": diagrams_dir / "fig-9-1-erd.png",
-    }
-
-    def _pick_diagram_path(base_path: Path | None) -> Path | None:
-        if base_path is None:
-            return None
-        vp_path = base_path.with_name(f"{base_path.stem}-vp{base_path.suffix}")
-        if vp_path.exists():
-            return vp_path
-        if base_path.exists():
-            return base_path
-        # If the base diagram is missing but the VP variant exists (e.g., autogen disabled),
-        # prefer the VP export when available.
-        return vp_path if vp_path.exists() else None
+    if not embed_images:
+        if autogen and registry is None:
+            ensure_default_diagrams(diagrams_dir)
+        registry = {}
+    elif registry is None:
+        registry = build_figure_registry(diagrams_dir, autogen=autogen)
 
     rels_root: ET.Element | None = None
     docpr_id = 1000
+    media_by_hash: dict[str, tuple[str, str]] = {}
+    placements: dict[str, dict] = {}
 
     body = root.find("w:body", NS)
     if body is None:
-        return
-
-    # Scan paragraphs and replace markers.
-    for p in list(body.findall("w:p", NS)):
+        return placements
+
+    # Scan body children once, building the replacement list as we go (no per-marker index/remove).
+    new_children: list[ET.Element] = []
+    replaced = False
+    for p in list(body):
+        if p.tag != _qn("w:p"):
+            new_children.append(p)
+            continue
         txt = _p_text(p)
         if not (txt.startswith(FIGURE_MARKER_PREFIX) and txt.endswith("]")):
+            new_children.append(p)
             continue
-        fig_id = txt[len(FIGURE_MARKER_PREFIX) : -1]
-        img_path = _pick_diagram_path(expected.get(fig_id))
-        if not embed_images:
-            body.remove(p)
-            continue
-        if not img_path or not img_path.exists():
-            body.remove(p)
+        replaced = True
+        fig = registry.get(txt[len(FIGURE_MARKER_PREFIX) : -1])
+        if fig is None:
             continue
 
         if rels_root is None:
@@ -842,35 +1193,30 @@ def embed_figures(
             rels_root = _ensure_document_rels(file_bytes)
             docpr_id = max(_max_docpr_id(root) + 1, 1000)
 
-        img_bytes = img_path.read_bytes()
-        media_name = f"image-fig-{fig_id}.png"
-        media_target = f"media/{media_name}"
-        file_bytes[f"word/{media_target}"] = img_bytes
+        data, media_key, cx, cy = _place_figure(fig, print_dpi=print_dpi, cache_dir=diagrams_dir / ".embed-cache")
 
-        rid = _add_image_relationship(rels_root, media_target)
-
-        with Image.open(img_path) as im:
-            cx = _px_to_emu(im.size[0])
-            cy = _px_to_emu(im.size[1])
-            # Fit to page width (roughly): cap width to ~6.5 inches.
-            max_cx = int(6.5 * EMU_PER_INCH)
-            if cx > max_cx:
-                scale = max_cx / max(cx, 1)
-                cx = int(cx * scale)
-                cy = int(cy * scale)
+        # Content-addressed media: the same image bytes get one part and one relationship,
+        # however many markers reference them.
+        shared = media_by_hash.get(media_key)
+        if shared is None:
+            media_name = f"image-{media_key}.png"
+            media_target = f"media/{media_name}"
+            file_bytes[f"word/{media_target}"] = data
+            shared = (_add_image_relationship(rels_root, media_target), media_name)
+            media_by_hash[media_key] = shared
+        rid, media_name = shared
+        placements[fig.fig_id] = {"rid": rid, "part": f"word/media/{media_name}", "cx": cx, "cy": cy}
 
         img_p = _make_image_paragraph(rid, cx=cx, cy=cy, docpr_id=docpr_id, name=media_name)
         docpr_id += 1
+        new_children.append(img_p)
 
-        idx = list(body).index(p)
-        body.remove(p)
-        body.insert(idx, img_p)
+    if replaced:
+        body[:] = new_children
 
     if rels_root is not None:
-        xml = ET.tostring(rels_root, encoding="utf-8", xml_declaration=True).decode("utf-8", errors="replace")
-        xml = re.sub(r"<(/?)rel:", r"<\1", xml)
-        xml = xml.replace(f'xmlns:rel=\"{REL_NS}\"', f'xmlns=\"{REL_NS}\"')
-        file_bytes["word/_rels/document.xml.rels"] = xml.encode("utf-8")
+        file_bytes["word/_rels/document.xml.rels"] = _rels_xml_bytes(rels_root)
+    return placements
 
 
 def replace_first_paragraph_text(root: ET.Element, old: str, new: str) -> None:
@@ -1064,7 +1410,8 @@ def rebuild_toc_like_template(root: ET.Element, *, content_start_idx: int) -> No
 
     # Capture existing (template) page numbers as a best-effort placeholder.
     # LibreOffice headless conversion often doesn't refresh fields, so keeping a number here
-    # avoids shipping a TOC with blank page numbers in the PDF.
+    # avoids shipping a TOC with blank page numbers in the PDF. `--toc-pages pdf` later overwrites
+    # them with real numbers (set_toc_page_numbers).
     old_pages: list[str] = []
     for el in list(children[toc_heading_idx + 1 : toc_end_idx]):
         if el.tag != _qn("w:p"):
@@ -1130,6 +1477,160 @@ def rebuild_toc_like_template(root: ET.Element, *, content_start_idx: int) -> No
         insert_at += 1
 
 
+def set_toc_page_numbers(root: ET.Element, pages: dict[str, int]) -> list[str]:
+    """
+    Write real page numbers into the cached results of the TOC's PAGEREF fields.
+    Returns the bookmark names that had no page in `pages` (their number is left as-is).
+    """
+    missing: list[str] = []
+    for fld in root.iter(_qn("w:fldSimple")):
+        m = re.match(r"\s*PAGEREF\s+(\S+)", fld.attrib.get(_qn("w:instr"), ""))
+        if not m:
+            continue
+        page = pages.get(m.group(1))
+        t = fld.find(".//w:t", NS)
+        if page is None or t is None:
+            missing.append(m.group(1))
+            continue
+        t.text = str(page)
+    return missing
+
+
+_PDF_OBJ_RE = re.compile(rb"(\d+)\s+\d+\s+obj\b")
+_PDF_REF_RE = re.compile(rb"(\d+)\s+\d+\s+R")
+_PDF_NAME_ESC_RE = re.compile(rb"#([0-9A-Fa-f]{2})")
+
+
+def _pdf_objects(data: bytes) -> dict[int, bytes]:
+    # Object dictionaries only: anything from "stream" on is binary payload we never need.
+    objs: dict[int, bytes] = {}
+    for m in _PDF_OBJ_RE.finditer(data):
+        end = data.find(b"endobj", m.end())
+        if end < 0:
+            continue
+        head = data[m.end() : end]
+        stream = head.find(b"stream")
+        objs[int(m.group(1))] = head if stream < 0 else head[:stream]
+    return objs
+
+
+def _pdf_dest_page_obj(value: bytes, objs: dict[int, bytes]) -> int | None:
+    # A destination is "[page 0 R /XYZ ...]", "<< /D [page 0 R ...] >>", or a reference to either.
+    value = value.lstrip()
+    if not value.startswith((b"[", b"<<")):
+        ref = _PDF_REF_RE.match(value)
+        value = objs.get(int(ref.group(1)), b"") if ref else b""
+    m = re.search(rb"\[\s*(\d+)\s+\d+\s+R", value)
+    return int(m.group(1)) if m else None
+
+
+def pdf_named_destination_pages(data: bytes) -> dict[str, int]:
+    """
+    Map the named destinations of a PDF (LibreOffice exports Word bookmarks as these) to
+    1-based page indices. A small reader for the uncompressed object dictionaries LibreOffice
+    writes; PDFs using object/xref streams are not supported and yield an empty map.
+    """
+    objs = _pdf_objects(data)
+    # The last trailer wins (incremental updates append newer ones).
+    roots = re.findall(rb"/Root\s+(\d+)\s+\d+\s+R", data)
+    catalog = objs.get(int(roots[-1]), b"") if roots else b""
+
+    page_index: dict[int, int] = {}
+
+    def walk_pages(num: int) -> None:
+        node = objs.get(num, b"")
+        if re.search(rb"/Type\s*/Page\b", node):
+            page_index[num] = len(page_index) + 1
+            return
+        kids = re.search(rb"/Kids\s*\[([^\]]*)\]", node)
+        for ref in _PDF_REF_RE.finditer(kids.group(1) if kids else b""):
+            walk_pages(int(ref.group(1)))
+
+    pages_m = re.search(rb"/Pages\s+(\d+)\s+\d+\s+R", catalog)
+    if pages_m:
+        walk_pages(int(pages_m.group(1)))
+
+    dests: dict[str, int] = {}
+
+    def add(name: bytes, value: bytes) -> None:
+        page_obj = _pdf_dest_page_obj(value, objs)
+        if page_obj in page_index:
+            key = _PDF_NAME_ESC_RE.sub(lambda m: bytes([int(m.group(1), 16)]), name).decode("latin-1")
+            dests[key] = page_index[page_obj]
+
+    # The catalog's /Names dictionary (PDF 1.2+ name tree) is handled below; cut it out first so its
+    # /Dests entry isn't mistaken for the PDF 1.1 style "/Dests <dict>" that LibreOffice writes.
+    names_m = re.search(rb"/Names\s*(?:<<(.*?)>>|(\d+)\s+\d+\s+R)", catalog, re.S)
+    names_body = b""
+    top = catalog
+    if names_m:
+        names_body = names_m.group(1) if names_m.group(1) is not None else objs.get(int(names_m.group(2)), b"")
+        top = catalog[: names_m.start()] + catalog[names_m.end() :]
+
+    dests_m = re.search(rb"/Dests\s+(\d+)\s+\d+\s+R", top)
+    dests_body = objs.get(int(dests_m.group(1)), b"") if dests_m else b""
+    for m in re.finditer(rb"/([^\s/\[\]<>()]+)\s*((?:\[[^\]]*\])|(?:\d+\s+\d+\s+R))", dests_body):
+        add(m.group(1), m.group(2))
+
+    tree_m = re.search(rb"/Dests\s+(\d+)\s+\d+\s+R", names_body)
+
+    def walk_names(num: int, seen: set[int]) -> None:
+        if num in seen:
+            return
+        seen.add(num)
+        node = objs.get(num, b"")
+        leaf = re.search(rb"/Names\s*\[(.*)\]", node, re.S)
+        if leaf:
+            entry_re = rb"\(((?:\\.|[^\\)])*)\)\s*((?:\[[^\]]*\])|(?:<<.*?>>)|(?:\d+\s+\d+\s+R))"
+            for m in re.finditer(entry_re, leaf.group(1), re.S):
+                add(re.sub(rb"\\(.)", rb"\1", m.group(1)), m.group(2))
+        kids = re.search(rb"/Kids\s*\[([^\]]*)\]", node)
+        for ref in _PDF_REF_RE.finditer(kids.group(1) if kids else b""):
+            walk_names(int(ref.group(1)), seen)
+
+    if tree_m:
+        walk_names(int(tree_m.group(1)), set())
+    return dests
+
+
+def render_pdf_with_bookmarks(docx_path: Path, out_dir: Path, *, timeout_s: float = 180.0) -> Path:
+    """
+    Convert a .docx to PDF with headless LibreOffice, exporting Word bookmarks as PDF named
+    destinations (the JSON filter-options syntax needs LibreOffice 7.4+).
+    """
+    # Only this path needs the shared profile cache (and fcntl); keep it out of normal builds.
+    from tools.lo_profile import ProfileLease
+
+    export = 'pdf:writer_pdf_Export:{"ExportBookmarksToPDFDestination":{"type":"boolean","value":"true"}}'
+    cmd = [
+        "soffice",
+        "--headless",
+        "--nologo",
+        "--nolockcheck",
+        "--nodefault",
+        "--norestore",
+        "--invisible",
+        "--convert-to",
+        export,
+        str(docx_path),
+        "--outdir",
+        str(out_dir),
+    ]
+    try:
+        # Cached, already-initialized profile shared with the tools/ scripts.
+        with ProfileLease() as profile_dir:
+            cmd.append(f"-env:UserInstallation={profile_dir.resolve().as_uri()}")
+            proc = subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, timeout=timeout_s)
+    except FileNotFoundError:
+        raise SystemExit("soffice (LibreOffice) not found; it is needed for --toc-pages pdf")
+    except subprocess.TimeoutExpired:
+        raise SystemExit("PDF render for TOC page numbers timed out (LibreOffice headless).")
+    pdf_path = out_dir / (docx_path.stem + ".pdf")
+    if proc.returncode != 0 or not pdf_path.exists():
+        raise SystemExit(f"PDF render for TOC page numbers failed (LibreOffice exit code: {proc.returncode}).")
+    return pdf_path
+
+
 def build_sad_content(*, fig_caption_red: bool = True) -> list[ET.Element]:
     el: list[ET.Element] = []
 
@@ -2053,26 +2554,383 @@ def build_sad_content(*, fig_caption_red: bool = True) -> list[ET.Element]:
     return el
 
 
+def _copy_zip_member_raw(zin: zipfile.ZipFile, zout: zipfile.ZipFile, info: zipfile.ZipInfo) -> None:
+    """
+    Copy one member's compressed bytes from zin to zout without decompressing them.
+    zipfile has no public API for this, so the local header is rebuilt from the ZipInfo.
+    """
+    assert zin.fp is not None and zout.fp is not None
+    zin.fp.seek(info.header_offset)
+    fheader = zin.fp.read(zipfile.sizeFileHeader)
+    name_len, extra_len = struct.unpack("<HH", fheader[26:30])
+    zin.fp.seek(info.header_offset + zipfile.sizeFileHeader + name_len + extra_len)
+
+    out_info = copy.copy(info)
+    # CRC/sizes are known, so put them in the local header instead of a trailing data descriptor.
+    out_info.flag_bits &= ~0x08
+    out_info.header_offset = zout.fp.tell()
+    zout.fp.write(out_info.FileHeader())
+    remaining = info.compress_size
+    while remaining > 0:
+        chunk = zin.fp.read(min(remaining, 1 << 20))
+        if not chunk:
+            raise zipfile.BadZipFile(f"Truncated member in template: {info.filename}")
+        zout.fp.write(chunk)
+        remaining -= len(chunk)
+
+    zout.filelist.append(out_info)
+    zout.NameToInfo[out_info.filename] = out_info
+    zout.start_dir = zout.fp.tell()
+    zout._didModify = True
+
+
+def write_docx_from_template(
+    out_path: Path,
+    template_path: Path,
+    file_bytes: dict[str, bytes],
+    *,
+    template_parts: dict[str, bytes],
+    compresslevel: int | None = None,
+    omit: set[str] | frozenset[str] = frozenset(),
+    xml_trees: dict[str, ET.Element] | None = None,
+) -> None:
+    """
+    Write the output package in template member order.
+
+    Members the generator replaced in file_bytes are (re)compressed; untouched template members
+    are raw-copied; parts that only exist in file_bytes (e.g. new media) are appended at the end.
+    New/replaced parts follow _zip_compress_type (deflate, unless an image/PDF barely compresses).
+    Template members named in `omit` are dropped.
+    Members in `xml_trees` are serialized straight into their (deflated) zip entry, so the XML is
+    never held as one bytes object and is compressed while it is being written.
+    """
+    xml_trees = xml_trees or {}
+
+    def _write_part(name: str, data: bytes) -> None:
+        compress_type = _zip_compress_type(name, data, compresslevel)
+        zout.writestr(name, data, compress_type=compress_type, compresslevel=compresslevel)
+
+    with zipfile.ZipFile(template_path, "r") as zin, zipfile.ZipFile(
+        out_path, "w", compression=zipfile.ZIP_DEFLATED, compresslevel=compresslevel
+    ) as zout:
+        seen: set[str] = set()
+        for info in zin.infolist():
+            name = info.filename
+            seen.add(name)
+            if name in omit:
+                continue
+            tree = xml_trees.get(name)
+            if tree is not None:
+                with zout.open(name, "w") as fh:
+                    ET.ElementTree(tree).write(fh, encoding="utf-8", xml_declaration=True)
+                continue
+            data = file_bytes.get(name)
+            if data is None or data is template_parts.get(name):
+                _copy_zip_member_raw(zin, zout, info)
+            else:
+                _write_part(name, data)
+        for name, data in file_bytes.items():
+            if name not in seen:
+                _write_part(name, data)
+
+
+def _sha256_bytes(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+
+def _build_manifest_path(out_path: Path) -> Path:
+    return out_path.with_name(out_path.name + ".build.json")
+
+
+def _load_build_manifest(path: Path) -> dict | None:
+    try:
+        data = json.loads(path.read_text(encoding="utf-8"))
+    except (OSError, ValueError):
+        return None
+    return data if isinstance(data, dict) and data.get("version") == 1 else None
+
+
+def _save_build_manifest(path: Path, manifest: dict) -> None:
+    tmp = path.with_suffix(path.suffix + ".tmp")
+    tmp.write_text(json.dumps(manifest, indent=2, sort_keys=True, ensure_ascii=False) + "\n", encoding="utf-8")
+    tmp.replace(path)
+
+
+def patch_figures_in_place(
+    out_path: Path,
+    placements: dict[str, dict],
+    registry: dict[str, FigureInfo],
+    changed: list[str],
+    *,
+    print_dpi: int | None,
+    cache_dir: Path,
+    compresslevel: int | None = None,
+) -> dict[str, dict] | None:
+    """
+    Swap the media of `changed` figures inside an existing output .docx: replace the media part,
+    retarget its relationship and, if the size changed, update the drawing extents.
+    Returns the new placements, or None when a full rebuild is needed instead.
+    """
+    rid_users: dict[str, int] = {}
+    for pl in placements.values():
+        rid_users[pl["rid"]] = rid_users.get(pl["rid"], 0) + 1
+    used_parts = {pl["part"] for fid, pl in placements.items() if fid not in changed}
+
+    rels_path = "word/_rels/document.xml.rels"
+    with zipfile.ZipFile(out_path, "r") as zin:
+        rels_root = ET.fromstring(zin.read(rels_path))
+        doc_xml = zin.read("word/document.xml")
+
+    rels_by_id = {rel.attrib.get("Id"): rel for rel in rels_root.findall(_qns(REL_NS, "Relationship"))}
+    new_placements = dict(placements)
+    file_bytes: dict[str, bytes] = {}
+    omit: set[str] = set()
+    # Per retargeted relationship: new media name (docPr/cNvPr) and, if the size changed, extents.
+    new_names: dict[str, str] = {}
+    new_extents: dict[str, tuple[int, int]] = {}
+    for fig_id in changed:
+        old = placements.get(fig_id)
+        fig = registry.get(fig_id)
+        # Shared (deduplicated) media or a figure that wasn't embedded before needs a full build.
+        if old is None or fig is None or rid_users.get(old["rid"], 0) != 1 or old["rid"] not in rels_by_id:
+            return None
+        data, media_key, cx, cy = _place_figure(fig, print_dpi=print_dpi, cache_dir=cache_dir)
+        part = f"word/media/image-{media_key}.png"
+        if part in used_parts:
+            return None
+        used_parts.add(part)
+        omit.add(old["part"])
+        file_bytes[part] = data
+        rels_by_id[old["rid"]].set("Target", part[len("word/") :])
+        new_names[old["rid"]] = part[len("word/media/") :]
+        if (cx, cy) != (old["cx"], old["cy"]):
+            new_extents[old["rid"]] = (cx, cy)
+        new_placements[fig_id] = {"rid": old["rid"], "part": part, "cx": cx, "cy": cy}
+    omit -= set(file_bytes)
+
+    file_bytes[rels_path] = _rels_xml_bytes(rels_root)
+    xml_trees: dict[str, ET.Element] = {}
+    if new_names:
+        # Keep the drawing identical to what a full rebuild would emit: names follow the media part.
+        doc_root = ET.fromstring(doc_xml)
+        for anchor in doc_root.iter(_qns(WP_NS, "anchor")):
+            blip = anchor.find(f".//{{{A_NS}}}blip")
+            rid = blip.attrib.get(_qns(R_NS, "embed")) if blip is not None else None
+            if rid not in new_names:
+                continue
+            for pr in (anchor.find(_qns(WP_NS, "docPr")), anchor.find(f".//{{{PIC_NS}}}cNvPr")):
+                if pr is not None:
+                    pr.set("name", new_names[rid])
+            if rid not in new_extents:
+                continue
+            cx, cy = new_extents[rid]
+            for ext in (anchor.find(_qns(WP_NS, "extent")), anchor.find(f".//{{{A_NS}}}xfrm/{{{A_NS}}}ext")):
+                if ext is not None:
+                    ext.set("cx", str(cx))
+                    ext.set("cy", str(cy))
+        xml_trees["word/document.xml"] = doc_root
+
+    tmp_out = out_path.with_suffix(out_path.suffix + ".tmp")
+    write_docx_from_template(
+        tmp_out, out_path, file_bytes, template_parts={}, compresslevel=compresslevel, omit=omit, xml_trees=xml_trees
+    )
+    tmp_out.replace(out_path)
+    return new_placements
+
+
+class BuildProfiler:
+    """
+    Per-phase wall time, tracemalloc peak and bytes in/out for --profile.
+    When disabled, phase() is a no-op so the build pays nothing for it.
+    """
+
+    def __init__(self, *, enabled: bool) -> None:
+        self.enabled = enabled
+        self.phases: list[dict] = []
+        self._t0 = 0.0
+
+    def start(self) -> None:
+        if self.enabled:
+            tracemalloc.start()
+            self._t0 = time.perf_counter()
+
+    @contextlib.contextmanager
+    def phase(self, name: str) -> Iterator[dict]:
+        stats: dict = {"bytes_in": 0, "bytes_out": 0}
+        if not self.enabled:
+            yield stats
+            return
+        tracemalloc.reset_peak()
+        t0 = time.perf_counter()
+        try:
+            yield stats
+        finally:
+            _, peak = tracemalloc.get_traced_memory()
+            self.phases.append(
+                {"phase": name, "wall_s": round(time.perf_counter() - t0, 4), "peak_traced_bytes": peak, **stats}
+            )
+
+    def finish(self, dest: str | None) -> None:
+        if not self.enabled:
+            return
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        report = {
+            "total_wall_s": round(time.perf_counter() - self._t0, 4),
+            "peak_traced_bytes": peak,
+            # ru_maxrss is KiB on Linux (bytes on macOS); reported as-is.
+            "max_rss": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+            "phases": self.phases,
+        }
+        text = json.dumps(report, indent=2)
+        if dest in (None, "-"):
+            print(text)
+        else:
+            Path(dest).write_text(text + "\n", encoding="utf-8")
+
+
 def main() -> int:
     parser = argparse.ArgumentParser()
     parser.add_argument("--embed-images", action="store_true", help="Embed diagram PNGs into the output .docx")
     parser.add_argument("--no-autogen-diagrams", action="store_true", help="Do not auto-generate placeholder diagrams")
     parser.add_argument("--out", default="SAD-Final.docx", help="Output .docx path")
+    parser.add_argument(
+        "--image-dpi",
+        type=int,
+        default=None,
+        help="Downscale embedded figures to this print resolution at their final size (e.g. 150/220/300)",
+    )
+    parser.add_argument(
+        "--zip-level",
+        type=int,
+        choices=range(10),
+        default=None,
+        metavar="0-9",
+        help="Deflate level (0-9); images that barely compress are stored instead",
+    )
+    parser.add_argument("--force", action="store_true", help="Ignore the build manifest and rebuild from scratch")
+    parser.add_argument(
+        "--toc-pages",
+        choices=("template", "pdf"),
+        default="template",
+        help=(
+            "TOC page numbers: 'template' keeps the template's old numbers as placeholders; 'pdf' renders "
+            "the output once with LibreOffice and writes the real page of each heading bookmark"
+        ),
+    )
+    parser.add_argument(
+        "--styles",
+        action="store_true",
+        help="Reference custom styles registered in styles.xml instead of inline formatting on every paragraph/run",
+    )
+    parser.add_argument(
+        "--profile",
+        nargs="?",
+        const="-",
+        default=None,
+        metavar="PATH",
+        help="Write a per-phase time/memory/bytes report as JSON (to PATH, or stdout if omitted)",
+    )
     args = parser.parse_args()
 
+    prof = BuildProfiler(enabled=args.profile is not None)
+    prof.start()
+    try:
+        return _build(args, prof)
+    finally:
+        prof.finish(args.profile)
+
+
+def _build(args: argparse.Namespace, prof: BuildProfiler) -> int:
     template_path = Path("SAD-Template.docx")
     out_path = Path(args.out)
     if not template_path.exists():
         raise SystemExit("Missing SAD-Template.docx")
 
-    with zipfile.ZipFile(template_path, "r") as zin:
-        file_bytes = {name: zin.read(name) for name in zin.namelist()}
+    # The figure registry is the single scan of diagrams/ for this build (placeholders,
+    # -vp preference, sizes, hashes); it also feeds the build manifest below.
+    diagrams_dir = Path("diagrams")
+    with prof.phase("figure_registry") as ph:
+        registry = (
+            build_figure_registry(diagrams_dir, autogen=not args.no_autogen_diagrams) if args.embed_images else None
+        )
+        ph["bytes_in"] = sum(len(fig.data) for fig in (registry or {}).values())
+
+    # Everything the output depends on. The date is included because the header/footer and the
+    # history table carry today's (Jalali) date.
+    manifest_path = _build_manifest_path(out_path)
+    inputs = {
+        "template": _sha256_bytes(template_path.read_bytes()),
+        "script": _sha256_bytes(Path(__file__).read_bytes()),
+        "group_members": get_group_members(),
+        "date": _dt.date.today().isoformat(),
+        "flags": {
+            "embed_images": args.embed_images,
+            "no_autogen_diagrams": args.no_autogen_diagrams,
+            "image_dpi": args.image_dpi,
+            "zip_level": args.zip_level,
+            "styles": args.styles,
+            "toc_pages": args.toc_pages,
+        },
+    }
+    figures = {fig_id: fig.sha256 for fig_id, fig in (registry or {}).items()}
+
+    prev = None if args.force else _load_build_manifest(manifest_path)
+    if (
+        prev is not None
+        and out_path.exists()
+        and prev.get("inputs") == inputs
+        and prev.get("output_sha256") == _sha256_bytes(out_path.read_bytes())
+    ):
+        prev_figures = prev.get("figures") or {}
+        if prev_figures == figures:
+            print(f"Up to date: {out_path}")
+            return 0
+        # A patched figure can change pagination, which real TOC page numbers would have to follow.
+        if registry is not None and args.toc_pages == "template" and set(prev_figures) == set(figures):
+            changed = sorted(fid for fid in figures if figures[fid] != prev_figures[fid])
+            placements = patch_figures_in_place(
+                out_path,
+                prev.get("placements") or {},
+                registry,
+                changed,
+                print_dpi=args.image_dpi,
+                cache_dir=diagrams_dir / ".embed-cache",
+                compresslevel=args.zip_level,
+            )
+            if placements is not None:
+                _save_build_manifest(
+                    manifest_path,
+                    {
+                        "version": 1,
+                        "inputs": inputs,
+                        "figures": figures,
+                        "placements": placements,
+                        "output_sha256": _sha256_bytes(out_path.read_bytes()),
+                    },
+                )
+                print(f"Patched {len(changed)} figure(s) in {out_path}: {', '.join(changed)}")
+                return 0
+
+    with prof.phase("template_unzip") as ph:
+        with zipfile.ZipFile(template_path, "r") as zin:
+            names = set(zin.namelist())
+            template_parts = {name: zin.read(name) for name in EDITABLE_PARTS if name in names}
+        ph["bytes_in"] = template_path.stat().st_size
+        ph["bytes_out"] = sum(len(v) for v in template_parts.values())
+    file_bytes = dict(template_parts)
 
     doc_xml = file_bytes.get("word/document.xml")
     if doc_xml is None:
         raise SystemExit("Template missing word/document.xml")
 
-    root = ET.fromstring(doc_xml)
+    with prof.phase("parse_document_xml") as ph:
+        root = ET.fromstring(doc_xml)
+        ph["bytes_in"] = len(doc_xml)
+
+    set_style_mode(args.styles)
+    if args.styles:
+        register_generated_styles(file_bytes)
 
     # Fill cover placeholders (best-effort)
     replace_first_paragraph_text(root, "سازمان ...", "سازمان آژانس مسافرتی مارکوپولو")
@@ -2105,39 +2963,95 @@ def main() -> int:
         body.remove(el)
 
     # Insert filled content
-    insert_pos = start_idx
-    for new_el in build_sad_content(fig_caption_red=not args.embed_images):
-        body.insert(insert_pos, new_el)
-        insert_pos += 1
+    with prof.phase("build_sad_content"):
+        insert_pos = start_idx
+        for new_el in build_sad_content(fig_caption_red=not args.embed_images):
+            body.insert(insert_pos, new_el)
+            insert_pos += 1
 
     # Optionally embed diagrams from ./diagrams into the document.
-    embed_figures(
-        root,
-        file_bytes,
-        diagrams_dir=Path("diagrams"),
-        autogen=not args.no_autogen_diagrams,
-        embed_images=args.embed_images,
-    )
+    with prof.phase("embed_figures") as ph:
+        placements = embed_figures(
+            root,
+            file_bytes,
+            diagrams_dir=diagrams_dir,
+            autogen=not args.no_autogen_diagrams,
+            embed_images=args.embed_images,
+            registry=registry,
+            print_dpi=args.image_dpi,
+        )
+        ph["bytes_out"] = sum(len(file_bytes[part]) for part in {pl["part"] for pl in placements.values()})
 
     # Keep the template TOC field and make sure it updates on open; also regenerate the visible
     # TOC entries based on current headings so the document doesn't ship with stale titles.
     ensure_toc_field(root, file_bytes)
-    rebuild_toc_like_template(root, content_start_idx=start_idx)
+    with prof.phase("rebuild_toc_like_template"):
+        rebuild_toc_like_template(root, content_start_idx=start_idx)
 
     # Fix header/footer placeholders (e.g., '...') after all edits.
     _update_header_footer_xml(file_bytes)
 
-    # Write output docx (preserve all other parts)
-    new_doc_xml = ET.tostring(root, encoding="utf-8", xml_declaration=True)
-    file_bytes["word/document.xml"] = new_doc_xml
-
+    # Write output docx (preserve all other parts). document.xml is streamed into its zip entry
+    # rather than materialized with ET.tostring first.
+    del file_bytes["word/document.xml"]
     tmp_out = out_path.with_suffix(out_path.suffix + ".tmp")
-    with zipfile.ZipFile(tmp_out, "w", compression=zipfile.ZIP_DEFLATED) as zout:
-        for name, data in file_bytes.items():
-            zout.writestr(name, data)
+    prev_size = out_path.stat().st_size if out_path.exists() else None
+    t0 = time.perf_counter()
+    with prof.phase("serialize_and_zip_write") as ph:
+        write_docx_from_template(
+            tmp_out,
+            template_path,
+            file_bytes,
+            template_parts=template_parts,
+            compresslevel=args.zip_level,
+            xml_trees={"word/document.xml": root},
+        )
+        if prof.enabled:
+            with zipfile.ZipFile(tmp_out, "r") as zcheck:
+                doc_size = zcheck.getinfo("word/document.xml").file_size
+            ph["bytes_in"] = sum(len(v) for v in file_bytes.values()) + doc_size
+        ph["bytes_out"] = tmp_out.stat().st_size
+    write_s = time.perf_counter() - t0
+
+    if args.toc_pages == "pdf":
+        # The page numbers only change digits after a tab, so they don't move anything else:
+        # one render of the placeholder build is enough.
+        with prof.phase("toc_pages_from_pdf") as ph, tempfile.TemporaryDirectory(prefix="sad-toc-") as tmp:
+            probe = Path(tmp) / "toc-probe.docx"
+            tmp_out.replace(probe)
+            pdf_bytes = render_pdf_with_bookmarks(probe, Path(tmp)).read_bytes()
+            ph["bytes_in"] = len(pdf_bytes)
+            missing = set_toc_page_numbers(root, pdf_named_destination_pages(pdf_bytes))
+            if missing:
+                print(
+                    f"Warning: no page found for {len(missing)} TOC bookmark(s) ({', '.join(missing[:5])}); "
+                    "kept placeholder numbers",
+                    file=sys.stderr,
+                )
+            write_docx_from_template(
+                tmp_out,
+                template_path,
+                file_bytes,
+                template_parts=template_parts,
+                compresslevel=args.zip_level,
+                xml_trees={"word/document.xml": root},
+            )
 
     tmp_out.replace(out_path)
-    print(f"Wrote {out_path}")
+    size = out_path.stat().st_size
+    delta = f", {(size - prev_size) / 1024:+.1f} KB vs previous" if prev_size is not None else ""
+    print(f"Wrote {out_path} ({size / 1024:.1f} KB, serialize+zip {write_s:.2f}s{delta})")
+
+    _save_build_manifest(
+        manifest_path,
+        {
+            "version": 1,
+            "inputs": inputs,
+            "figures": figures,
+            "placements": placements,
+            "output_sha256": _sha256_bytes(out_path.read_bytes()),
+        },
+    )
     return 0
 
 
@@ -0,0 +1,233 @@
+#!/usr/bin/env python3
+from __future__ import annotations
+
+import argparse
+import copy
+import io
+import json
+import math
+import struct
+import sys
+import tempfile
+import time
+import xml.etree.ElementTree as ET
+import zipfile
+import zlib
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import generate_sad_final_docx as gen  # noqa: E402
+
+
+# Roughly the current SAD: scale 1 == today's document size.
+BASE_HEADINGS = 60
+BASE_TABLES = 34
+BASE_FIGURES = 17
+
+STAGES = ("build", "embed_figures", "ensure_heading_bookmarks", "rebuild_toc_like_template", "serialize")
+
+
+def _solid_png(width: int, height: int) -> bytes:
+    # Minimal white RGB PNG; only the headers matter to the pipeline.
+    def chunk(ctype: bytes, data: bytes) -> bytes:
+        return struct.pack(">I", len(data)) + ctype + data + struct.pack(">I", zlib.crc32(ctype + data))
+
+    raw = (b"\x00" + b"\xff" * (width * 3)) * height
+    return (
+        b"\x89PNG\r\n\x1a\n"
+        + chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0))
+        + chunk(b"IDAT", zlib.compress(raw))
+        + chunk(b"IEND", b"")
+    )
+
+
+def _synthesize(headings: int, tables: int, figures: int) -> tuple[ET.Element, int]:
+    """
+    Build a document.xml root shaped like the generator's output: a TOC area followed by
+    content with `headings` headings and `tables`/`figures` spread evenly between them.
+    Returns (root, content_start_idx).
+    """
+    root = ET.Element(gen._qn("w:document"))
+    body = ET.SubElement(root, gen._qn("w:body"))
+    body.append(gen.make_p("فهرست مطالب"))
+    body.append(gen.make_p("placeholder", style="TOC1"))
+    body.append(gen.make_p("سند معماری نرم‌افزار"))
+    content_start_idx = len(body)
+
+    tables_left, figures_left = tables, figures
+    for i in range(headings):
+        style = "Heading1" if i % 5 == 0 else "Heading2"
+        body.append(gen.make_p(f"Heading {i + 1}", style=style))
+        body.append(gen.make_p("Body text " * 20, jc="both"))
+        # Distribute tables/figures as evenly as possible across headings.
+        for _ in range(tables_left // (headings - i)):
+            body.append(
+                gen.make_tbl(
+                    ["Col A", "Col B", "Col C"],
+                    [[f"r{r}c{c}" for c in range(3)] for r in range(6)],
+                    col_weights=[1, 2, 2],
+                )
+            )
+            tables_left -= 1
+        for _ in range(figures_left // (headings - i)):
+            body.append(gen.make_fig_marker(f"b-{figures - figures_left}"))
+            figures_left -= 1
+    ET.SubElement(body, gen._qn("w:sectPr"))
+    return root, content_start_idx
+
+
+def _registry(figures: int, png: bytes, tmp_dir: Path) -> dict[str, gen.FigureInfo]:
+    width, height, dpi = gen.probe_image(png)
+    sha = gen._sha256_bytes(png)
+    return {
+        f"b-{i}": gen.FigureInfo(
+            fig_id=f"b-{i}",
+            path=tmp_dir / f"fig-b-{i}.png",
+            is_vp=False,
+            width=width,
+            height=height,
+            dpi=dpi,
+            # Distinct hashes so deduplication doesn't hide the per-figure cost.
+            sha256=f"{i:016x}{sha[16:]}",
+            data=png,
+        )
+        for i in range(figures)
+    }
+
+
+def run_scale(scale: int, *, repeat: int, png: bytes, tmp_dir: Path) -> dict:
+    headings, tables, figures = BASE_HEADINGS * scale, BASE_TABLES * scale, BASE_FIGURES * scale
+    best = {stage: math.inf for stage in STAGES}
+    elements = 0
+    xml_bytes = 0
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        root, start_idx = _synthesize(headings, tables, figures)
+        best["build"] = min(best["build"], time.perf_counter() - t0)
+
+        file_bytes: dict[str, bytes] = {}
+        registry = _registry(figures, png, tmp_dir)
+        t0 = time.perf_counter()
+        gen.embed_figures(root, file_bytes, diagrams_dir=tmp_dir, autogen=False, registry=registry)
+        best["embed_figures"] = min(best["embed_figures"], time.perf_counter() - t0)
+
+        # Measured on a copy: rebuild_toc_like_template adds the bookmarks itself.
+        scratch = copy.deepcopy(root)
+        t0 = time.perf_counter()
+        gen.ensure_heading_bookmarks(scratch, content_start_idx=start_idx)
+        best["ensure_heading_bookmarks"] = min(best["ensure_heading_bookmarks"], time.perf_counter() - t0)
+
+        t0 = time.perf_counter()
+        gen.rebuild_toc_like_template(root, content_start_idx=start_idx)
+        best["rebuild_toc_like_template"] = min(best["rebuild_toc_like_template"], time.perf_counter() - t0)
+
+        # Same path as write_docx_from_template: ElementTree.write streamed into a deflated entry.
+        t0 = time.perf_counter()
+        with zipfile.ZipFile(io.BytesIO(), "w", compression=zipfile.ZIP_DEFLATED) as zout:
+            with zout.open("word/document.xml", "w") as fh:
+                ET.ElementTree(root).write(fh, encoding="utf-8", xml_declaration=True)
+            xml_bytes = zout.getinfo("word/document.xml").file_size
+        best["serialize"] = min(best["serialize"], time.perf_counter() - t0)
+
+        elements = sum(1 for _ in root.iter())
+
+    return {
+        "scale": scale,
+        "headings": headings,
+        "tables": tables,
+        "figures": figures,
+        "elements": elements,
+        "xml_bytes": xml_bytes,
+        "stages_s": {stage: round(best[stage], 6) for stage in STAGES},
+    }
+
+
+def _content_xml_bytes(*, styled: bool) -> int:
+    # The real SAD content (no template), serialized as it would be in document.xml.
+    gen.set_style_mode(styled)
+    try:
+        return sum(len(ET.tostring(el, encoding="utf-8")) for el in gen.build_sad_content())
+    finally:
+        gen.set_style_mode(False)
+
+
+def _slope(results: list[dict], stage: str) -> float | None:
+    # log-log slope between the smallest and largest scale: ~1 is linear, ~2 quadratic.
+    lo, hi = results[0], results[-1]
+    t_lo, t_hi = lo["stages_s"][stage], hi["stages_s"][stage]
+    if lo["scale"] == hi["scale"] or t_lo <= 0 or t_hi <= 0:
+        return None
+    return math.log(t_hi / t_lo) / math.log(hi["scale"] / lo["scale"])
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(
+        description="Benchmark the SAD generator stages on synthetic documents of growing size."
+    )
+    parser.add_argument("--scales", default="1,2,4,8", help="Comma-separated size multipliers of today's SAD")
+    parser.add_argument("--repeat", type=int, default=3, help="Runs per scale (best time is kept)")
+    parser.add_argument("--save-baseline", type=Path, default=None, help="Write results JSON here")
+    parser.add_argument("--compare", type=Path, default=None, help="Baseline JSON to compare against")
+    parser.add_argument(
+        "--styles",
+        action="store_true",
+        help="Benchmark the style-referencing (--styles) output and compare its size with inline formatting",
+    )
+    args = parser.parse_args()
+
+    if args.styles:
+        inline_size = _content_xml_bytes(styled=False)
+        styled_size = _content_xml_bytes(styled=True)
+        print(
+            f"SAD content: {inline_size / 1024:.1f} KB inline -> {styled_size / 1024:.1f} KB with styles "
+            f"({(styled_size - inline_size) / inline_size:+.0%})"
+        )
+    gen.set_style_mode(args.styles)
+
+    scales = sorted({int(s) for s in args.scales.split(",") if s.strip()})
+    png = _solid_png(1600, 900)
+
+    results: list[dict] = []
+    with tempfile.TemporaryDirectory(prefix="sad-bench-") as tmp:
+        for scale in scales:
+            res = run_scale(scale, repeat=max(1, args.repeat), png=png, tmp_dir=Path(tmp))
+            results.append(res)
+            stage_txt = "  ".join(f"{k}={v * 1000:.1f}ms" for k, v in res["stages_s"].items())
+            total = sum(res["stages_s"].values())
+            print(
+                f"scale {scale:>3}: {res['elements']} elements, {res['xml_bytes'] / 1024:.0f} KB xml, "
+                f"{res['elements'] / max(total, 1e-9):,.0f} elements/s | {stage_txt}"
+            )
+
+    if len(results) > 1:
+        print("scaling exponent (1.0 = linear):")
+        for stage in STAGES:
+            slope = _slope(results, stage)
+            print(f"  {stage}: {slope:.2f}" if slope is not None else f"  {stage}: n/a")
+
+    if args.compare is not None:
+        baseline = {r["scale"]: r for r in json.loads(args.compare.read_text(encoding="utf-8"))["results"]}
+        print(f"vs baseline {args.compare}:")
+        for res in results:
+            base = baseline.get(res["scale"])
+            if base is None:
+                continue
+            ratios = "  ".join(
+                f"{stage}={res['stages_s'][stage] / base['stages_s'][stage]:.2f}x"
+                for stage in STAGES
+                if base["stages_s"].get(stage)
+            )
+            print(f"  scale {res['scale']:>3}: {ratios}")
+
+    if args.save_baseline is not None:
+        args.save_baseline.parent.mkdir(parents=True, exist_ok=True)
+        args.save_baseline.write_text(
+            json.dumps({"python": sys.version.split()[0], "results": results}, indent=2) + "\n", encoding="utf-8"
+        )
+        print(f"Wrote baseline: {args.save_baseline}")
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+from __future__ import annotations
+
+import argparse
+import fcntl
+import os
+import shutil
+import time
+from pathlib import Path
+
+# LibreOffice spends seconds initializing a fresh user profile, so the tools share a few cached
+# ones instead of creating a new directory per run. A profile can only be used by one soffice at a
+# time (a second process would hand its work to the first over the profile's IPC pipe and exit), so
+# each slot is guarded by an exclusive flock; concurrent runs take the next free slot.
+DEFAULT_SLOTS = 4
+
+
+def default_profile_root() -> Path:
+    env = os.environ.get("SAD_LO_PROFILE_ROOT")
+    if env:
+        return Path(env)
+    cache = Path(os.environ.get("XDG_CACHE_HOME") or Path.home() / ".cache")
+    return cache / "ase-marcopolo-docs" / "lo-profiles"
+
+
+def profile_is_valid(profile_dir: Path) -> bool:
+    # soffice writes registrymodifications.xcu at the end of first-run initialization; a missing or
+    # truncated one means the profile was interrupted (killed/timed out) and must be rebuilt.
+    xcu = profile_dir / "user" / "registrymodifications.xcu"
+    try:
+        with xcu.open("rb") as fh:
+            fh.seek(max(0, xcu.stat().st_size - 64))
+            return b"</oor:items>" in fh.read()
+    except OSError:
+        return False
+
+
+class ProfileLease:
+    """
+    Exclusive use of one cached LibreOffice profile directory.
+
+    acquire() returns the directory (under default_profile_root() unless `root` is given); a slot that
+    exists but fails validation is wiped so soffice re-initializes it. release() keeps the directory.
+    """
+
+    def __init__(self, root: Path | None = None, *, slots: int = DEFAULT_SLOTS) -> None:
+        self.root = root or default_profile_root()
+        self.slots = max(1, slots)
+        self.path: Path | None = None
+        self.reused = False
+        self._lock_fh = None
+
+    def __enter__(self) -> Path:
+        return self.acquire()
+
+    def __exit__(self, *exc: object) -> None:
+        self.release()
+
+    def acquire(self, *, timeout_s: float = 600.0) -> Path:
+        if self.path is not None:
+            return self.path
+        self.root.mkdir(parents=True, exist_ok=True)
+        deadline = time.monotonic() + timeout_s
+        while True:
+            for slot in range(self.slots):
+                fh = open(self.root / f"slot-{slot}.lock", "a+")
+                try:
+                    fcntl.flock(fh, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    fh.close()
+                    continue
+                self._lock_fh = fh
+                self.path = self.root / f"slot-{slot}"
+                self.reused = profile_is_valid(self.path)
+                if not self.reused and self.path.exists():
+                    shutil.rmtree(self.path, ignore_errors=True)
+                self.path.mkdir(parents=True, exist_ok=True)
+                return self.path
+            if time.monotonic() > deadline:
+                raise RuntimeError(f"All {self.slots} LibreOffice profile slots under {self.root} stayed busy")
+            time.sleep(0.5)
+
+    def release(self) -> None:
+        fh, self._lock_fh = self._lock_fh, None
+        self.path = None
+        if fh is not None:
+            fcntl.flock(fh, fcntl.LOCK_UN)
+            fh.close()
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Inspect or reset the cached LibreOffice profiles used by the tools.")
+    parser.add_argument("command", choices=("status", "clear"))
+    parser.add_argument("--root", type=Path, default=None, help="Profile root (default: user cache dir)")
+    args = parser.parse_args()
+
+    root = args.root or default_profile_root()
+    slots = sorted(p for p in root.glob("slot-*") if p.is_dir()) if root.exists() else []
+    if args.command == "status":
+        print(f"Profile root: {root}")
+        for p in slots:
+            print(f"  {p.name}: {'valid' if profile_is_valid(p) else 'not initialized'}")
+        return 0
+    for p in slots:
+        # Take the slot's lock so a running soffice doesn't lose its profile underneath it.
+        with open(root / f"{p.name}.lock", "a+") as fh:
+            try:
+                fcntl.flock(fh, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                print(f"  {p.name}: in use, skipped")
+                continue
+            shutil.rmtree(p, ignore_errors=True)
+            print(f"  {p.name}: removed")
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
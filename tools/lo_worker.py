@@ -0,0 +1,422 @@
+#!/usr/bin/env python3
+from __future__ import annotations
+
+import argparse
+import os
+import socket
+import subprocess
+import sys
+import threading
+import time
+from pathlib import Path
+from typing import Callable, Iterator
+
+import uno
+
+from lo_profile import ProfileLease, default_profile_root
+
+# Writer import/export filters used by the tools.
+DOCX_FILTER = "MS Word 2007 XML"
+PDF_FILTER = "writer_pdf_Export"
+
+# loadComponentFromURL raises these for the document itself (unreadable file, filter error); retrying
+# can't help, unlike the refusals of an office that is still starting up.
+_DOCUMENT_ERRORS = ("IllegalArgumentException", "IOException")
+# Bound for the health check round trip; a responsive office answers in milliseconds.
+HEALTH_TIMEOUT_S = 5.0
+# Launch attempts on fresh free ports before giving up (see _free_port).
+_PORT_ATTEMPTS = 3
+
+
+def _prop(name: str, value) -> object:
+    p = uno.createUnoStruct("com.sun.star.beans.PropertyValue")
+    p.Name = name
+    p.Value = value
+    return p
+
+
+def _file_url(path: Path) -> str:
+    return path.resolve().as_uri()
+
+
+def _call_with_deadline(fn: Callable[[], object], *, timeout_s: float) -> object:
+    """
+    Run one UNO bridge call on a helper thread and wait at most timeout_s for it. pyuno calls have
+    no timeout of their own, so a hung office would block the caller forever; on TimeoutError the
+    helper thread stays blocked until the office is killed (it is a daemon, so it never holds up exit).
+    """
+    outcome: list[tuple[bool, object]] = []
+
+    def _run() -> None:
+        try:
+            outcome.append((True, fn()))
+        except BaseException as e:
+            outcome.append((False, e))
+
+    t = threading.Thread(target=_run, daemon=True)
+    t.start()
+    t.join(timeout_s)
+    if not outcome:
+        raise TimeoutError(f"no answer from LibreOffice within {timeout_s:.0f}s")
+    ok, value = outcome[0]
+    if not ok:
+        raise value
+    return value
+
+
+def _resolve_desktop(host: str, port: int) -> object:
+    local_ctx = uno.getComponentContext()
+    resolver = local_ctx.ServiceManager.createInstanceWithContext("com.sun.star.bridge.UnoUrlResolver", local_ctx)
+    ctx = resolver.resolve(f"uno:socket,host={host},port={port};urp;StarOffice.ComponentContext")
+    return ctx.ServiceManager.createInstanceWithContext("com.sun.star.frame.Desktop", ctx)
+
+
+def advertised_port_file() -> Path:
+    # Where `lo_worker.py serve` publishes its port, next to the cached profiles.
+    return default_profile_root().parent / "lo-worker.port"
+
+
+def advertised_port() -> int | None:
+    try:
+        return int(advertised_port_file().read_text(encoding="utf-8").strip())
+    except (OSError, ValueError):
+        return None
+
+
+def _free_port(host: str) -> int:
+    # Let the kernel pick a port that is unused right now. Another process can still grab it before
+    # soffice binds it; OfficeWorker.start() retries on a new port when soffice exits early.
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.bind((host, 0))
+        return s.getsockname()[1]
+
+
+def _is_document_error(e: Exception) -> bool:
+    # pyuno names exception classes after the full UNO type, e.g. "com.sun.star.io.IOException".
+    return any(c.__name__.rsplit(".", 1)[-1] in _DOCUMENT_ERRORS for c in type(e).__mro__)
+
+
+def _backoff(initial_s: float = 0.01, cap_s: float = 0.5) -> Iterator[float]:
+    delay = initial_s
+    while True:
+        yield delay
+        delay = min(delay * 2, cap_s)
+
+
+def _port_open(host: str, port: int) -> bool:
+    try:
+        with socket.create_connection((host, port), timeout=0.2):
+            return True
+    except OSError:
+        return False
+
+
+def _connect_desktop(
+    host: str, port: int, *, timeout_s: float, proc: subprocess.Popen | None = None
+) -> object:
+    """
+    Wait until soffice accepts on host:port, then resolve the Desktop. The accept socket is probed
+    with exponential backoff (cheap, no UNO bridge per attempt), and a soffice that exits while
+    starting up fails immediately instead of after the whole timeout.
+    """
+    deadline = time.monotonic() + timeout_s
+    last_err: Exception | None = None
+    for delay in _backoff():
+        if proc is not None and proc.poll() is not None:
+            raise RuntimeError(f"soffice exited during startup (exit code: {proc.returncode})")
+        if _port_open(host, port):
+            try:
+                return _call_with_deadline(
+                    lambda: _resolve_desktop(host, port), timeout_s=max(0.1, deadline - time.monotonic())
+                )
+            except Exception as e:  # pragma: no cover
+                # Socket is up but the bridge isn't ready yet.
+                last_err = e
+        if time.monotonic() + delay > deadline:
+            break
+        time.sleep(delay)
+    raise RuntimeError(f"Failed to connect to LibreOffice UNO within {timeout_s:.0f}s (last error: {last_err})")
+
+
+def _refresh_doc(doc: object) -> None:
+    # Update indexes (TOC is an index) and fields.
+    try:
+        indexes = doc.getDocumentIndexes()
+        for i in range(indexes.getCount()):
+            indexes.getByIndex(i).update()
+    except Exception:
+        pass
+    try:
+        doc.refresh()
+    except Exception:
+        pass
+    try:
+        doc.getTextFields().refresh()
+    except Exception:
+        pass
+
+
+class OfficeWorker:
+    """
+    One headless LibreOffice instance behind a UNO connection, reused for every document.
+
+    By default the worker starts and owns its office, on `port` or else a free ephemeral one, with
+    `profile_dir` or else a cached profile leased from lo_profile for the worker's lifetime.
+    With attach=True it instead connects to an office already listening on host:port (or the port
+    advertised by `lo_worker.py serve`) and leaves it running on close().
+    Every bridge call is bounded (call_timeout_s, HEALTH_TIMEOUT_S for the health check): an owned
+    office that stops answering is killed, and the next operation restarts it, as after a crash.
+    """
+
+    def __init__(
+        self,
+        *,
+        host: str = "127.0.0.1",
+        port: int | None = None,
+        attach: bool = False,
+        profile_dir: Path | None = None,
+        timeout_s: float = 20.0,
+        call_timeout_s: float = 60.0,
+    ) -> None:
+        self.host = host
+        self.port = port
+        self.attach = attach
+        self.profile_dir = profile_dir
+        self.timeout_s = timeout_s
+        self.call_timeout_s = call_timeout_s
+        self.restarts = 0
+        # Seconds from start() until the Desktop answered, and whether an existing office was reused.
+        self.ready_s: float | None = None
+        self.attached = False
+        self._fixed_port = port is not None
+        self._started_at: float | None = None
+        self._proc: subprocess.Popen | None = None
+        self._desktop = None
+        self._lease: ProfileLease | None = None
+
+    def __enter__(self) -> OfficeWorker:
+        self.start()
+        return self
+
+    def __exit__(self, *exc: object) -> None:
+        self.close()
+
+    def start(self) -> None:
+        t0 = time.monotonic()
+        if self.attach:
+            if not self._fixed_port:
+                # Re-read on every (re)connect: serve restarts its office on a new port and re-advertises it.
+                self.port = advertised_port()
+                if self.port is None:
+                    raise RuntimeError(f"No LibreOffice worker to attach to ({advertised_port_file()} not found)")
+            if not _port_open(self.host, self.port):
+                raise RuntimeError(f"No LibreOffice listening on {self.host}:{self.port} to attach to")
+            try:
+                self._desktop = _call_with_deadline(
+                    lambda: _resolve_desktop(self.host, self.port), timeout_s=self.timeout_s
+                )
+            except Exception as e:
+                raise RuntimeError(f"Failed to attach to LibreOffice on {self.host}:{self.port}: {e}") from e
+            self.attached = True
+            self.ready_s = time.monotonic() - t0
+            return
+        if self.profile_dir is None:
+            self._lease = ProfileLease()
+            self.profile_dir = self._lease.acquire()
+        self.profile_dir.mkdir(parents=True, exist_ok=True)
+        attempts = 1 if self._fixed_port else _PORT_ATTEMPTS
+        for attempt in range(attempts):
+            if not self._fixed_port:
+                # A new port on every (re)start: the old one may have been taken since.
+                self.port = _free_port(self.host)
+            cmd = [
+                "soffice",
+                "--headless",
+                "--nologo",
+                "--nolockcheck",
+                "--nodefault",
+                "--norestore",
+                "--invisible",
+                f"--accept=socket,host={self.host},port={self.port};urp;",
+                f"-env:UserInstallation={_file_url(self.profile_dir)}",
+            ]
+            self._proc = subprocess.Popen(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            try:
+                self._desktop = _connect_desktop(self.host, self.port, timeout_s=self.timeout_s, proc=self._proc)
+                break
+            except Exception:
+                exited_early = self._proc.poll() is not None
+                self._kill()
+                if exited_early and attempt + 1 < attempts:
+                    # Most likely the port was taken between _free_port() and soffice's bind.
+                    continue
+                self._release_profile()
+                raise
+        self._started_at = time.monotonic()
+        self.ready_s = self._started_at - t0
+
+    def healthy(self) -> bool:
+        if self._desktop is None or (self._proc is not None and self._proc.poll() is not None):
+            return False
+        desktop = self._desktop
+        try:
+            # Any round trip over the bridge; raises DisposedException once the office is gone.
+            _call_with_deadline(lambda: desktop.getFrames().getCount(), timeout_s=HEALTH_TIMEOUT_S)
+            return True
+        except Exception:
+            return False
+
+    def ensure(self) -> None:
+        if self.healthy():
+            return
+        if self._desktop is not None:
+            self.restarts += 1
+            print("LibreOffice worker is not responding; restarting it.", file=sys.stderr)
+        # Kills a hung office too; a dead one is already gone.
+        self._kill()
+        self.start()
+
+    def describe_ready(self) -> str:
+        how = "attached to running LibreOffice" if self.attached else "started LibreOffice"
+        return f"{how} on {self.host}:{self.port}, ready in {self.ready_s or 0.0:.2f}s"
+
+    def load(self, path: Path) -> object:
+        load_props = (
+            _prop("Hidden", True),
+            _prop("ReadOnly", False),
+            # Make the importer explicit; in some environments LO may not auto-detect .docx reliably via UNO.
+            _prop("FilterName", DOCX_FILTER),
+        )
+        last_err: Exception | None = None
+        for _ in range(2):
+            self.ensure()
+            for delay in _backoff(0.05, 1.0):
+                desktop = self._desktop
+                try:
+                    doc = self._call(
+                        f"loading {path.name}",
+                        lambda: desktop.loadComponentFromURL(_file_url(path), "_blank", 0, load_props),
+                    )
+                except RuntimeError:
+                    # Timed out: the office was killed over this document, so don't feed it again.
+                    raise
+                except Exception as e:
+                    if _is_document_error(e):
+                        raise RuntimeError(f"LibreOffice rejected {path}: {e}") from e
+                    last_err, doc = e, None
+                if doc is not None:
+                    return doc
+                if not self.healthy():
+                    # Bridge disposed/office gone: restart it and try once more.
+                    break
+                if not self._warming_up(delay):
+                    raise RuntimeError(f"Failed to load document via UNO: {path} (last error: {last_err})")
+                time.sleep(delay)
+        raise RuntimeError(f"Failed to load document via UNO: {path} (last error: {last_err})")
+
+    def _warming_up(self, delay: float) -> bool:
+        # A freshly started office can refuse loads for a moment; an attached one is long past that.
+        if self._proc is None or self._started_at is None:
+            return False
+        return time.monotonic() + delay < self._started_at + self.timeout_s
+
+    def refresh(self, doc: object) -> None:
+        self._call("refreshing fields", lambda: _refresh_doc(doc))
+
+    def store_docx(self, doc: object, path: Path) -> None:
+        props = (_prop("FilterName", DOCX_FILTER), _prop("Overwrite", True))
+        self._call(f"saving {path.name}", lambda: doc.storeToURL(_file_url(path), props))
+
+    def export_pdf(self, doc: object, path: Path) -> None:
+        props = (_prop("FilterName", PDF_FILTER), _prop("Overwrite", True))
+        self._call(f"exporting {path.name}", lambda: doc.storeToURL(_file_url(path), props))
+
+    def close_doc(self, doc: object) -> None:
+        try:
+            self._call("closing the document", lambda: doc.close(True), timeout_s=HEALTH_TIMEOUT_S)
+        except Exception:
+            pass
+
+    def close(self) -> None:
+        if self.attached:
+            # Borrowed office: leave it running for the next run.
+            self._desktop = None
+            return
+        desktop = self._desktop
+        if desktop is not None and self._proc is not None and self._proc.poll() is None:
+            try:
+                self._call("shutting down", lambda: desktop.terminate(), timeout_s=HEALTH_TIMEOUT_S)
+            except Exception:
+                pass
+        self._desktop = None
+        self._kill()
+        self._release_profile()
+
+    def _call(self, what: str, fn: Callable[[], object], *, timeout_s: float | None = None) -> object:
+        timeout_s = self.call_timeout_s if timeout_s is None else timeout_s
+        try:
+            return _call_with_deadline(fn, timeout_s=timeout_s)
+        except TimeoutError:
+            # Hung office: kill ours (keeping the handle, so healthy() sees it exited) and the next
+            # ensure() starts a fresh one. An attached office is left alone; its health check times out.
+            if self._proc is not None:
+                self._proc.kill()
+                self._proc.wait()
+            raise RuntimeError(f"LibreOffice did not finish {what} within {timeout_s:.0f}s") from None
+
+    def _release_profile(self) -> None:
+        lease, self._lease = self._lease, None
+        if lease is not None:
+            lease.release()
+            self.profile_dir = None
+
+    def _kill(self) -> None:
+        proc, self._proc = self._proc, None
+        if proc is None:
+            return
+        proc.terminate()
+        try:
+            proc.wait(timeout=5)
+        except Exception:
+            proc.kill()
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(
+        description="Keep a headless LibreOffice running for the docx tools to reuse (Ctrl-C to stop)."
+    )
+    parser.add_argument("command", choices=("serve",))
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument(
+        "--port", type=int, default=None, help="UNO port (default: a free one, advertised for --attach clients)"
+    )
+    parser.add_argument(
+        "--profile-dir", type=Path, default=None, help="LibreOffice profile (default: a cached one from lo_profile.py)"
+    )
+    parser.add_argument("--check-interval-s", type=float, default=5.0, help="Health check period")
+    args = parser.parse_args()
+
+    worker = OfficeWorker(host=args.host, port=args.port, profile_dir=args.profile_dir)
+    worker.start()
+    print(f"LibreOffice worker: {worker.describe_ready()}")
+    port_file = advertised_port_file()
+    port_file.parent.mkdir(parents=True, exist_ok=True)
+    try:
+        while True:
+            # Re-advertise every round: a restarted office listens on a new port.
+            tmp = port_file.with_name(f"{port_file.name}.{os.getpid()}")
+            tmp.write_text(f"{worker.port}\n", encoding="utf-8")
+            tmp.replace(port_file)
+            time.sleep(args.check_interval_s)
+            worker.ensure()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if advertised_port() == worker.port:
+            port_file.unlink(missing_ok=True)
+        worker.close()
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
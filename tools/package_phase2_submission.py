@@ -7,9 +7,21 @@ import shutil
 import subprocess
 import sys
 import tempfile
+import time
 import zipfile
+import zlib
 from pathlib import Path
 
+from lo_profile import ProfileLease
+
+try:
+    from lo_worker import OfficeWorker
+except ImportError:  # LibreOffice's Python UNO bindings are not importable here
+    OfficeWorker = None
+
+# Upper bound for a DOCX -> PDF conversion, and for each UNO call (load/refresh/export) of the worker.
+PDF_TIMEOUT_S = 60
+
 
 def _sanitize_filename(text: str) -> str:
     text = text.strip()
@@ -61,30 +73,30 @@ def _extract_fig_captions(py_path: Path) -> dict[str, str]:
 
 def _run_soffice_convert_to_pdf(docx_path: Path, out_dir: Path) -> Path:
     out_dir.mkdir(parents=True, exist_ok=True)
-    profile_dir = out_dir / ".lo-profile"
-    profile_dir.mkdir(parents=True, exist_ok=True)
-    profile_url = profile_dir.resolve().as_uri()
-    cmd = [
-        "soffice",
-        "--headless",
-        "--nologo",
-        "--nolockcheck",
-        "--nodefault",
-        "--norestore",
-        "--invisible",
-        "--convert-to",
-        "pdf",
-        str(docx_path),
-        "--outdir",
-        str(out_dir),
-        f"-env:UserInstallation={profile_url}",
-    ]
-    proc = subprocess.Popen(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-    try:
-        proc.wait(timeout=60)
-    except subprocess.TimeoutExpired:
-        proc.kill()
-        raise RuntimeError("PDF conversion timed out (LibreOffice headless).")
+    # Cached, already-initialized profile (see lo_profile.py) instead of a fresh one per run.
+    with ProfileLease() as profile_dir:
+        cmd = [
+            "soffice",
+            "--headless",
+            "--nologo",
+            "--nolockcheck",
+            "--nodefault",
+            "--norestore",
+            "--invisible",
+            "--convert-to",
+            "pdf",
+            str(docx_path),
+            "--outdir",
+            str(out_dir),
+            f"-env:UserInstallation={profile_dir.resolve().as_uri()}",
+        ]
+        proc = subprocess.Popen(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        try:
+            proc.wait(timeout=PDF_TIMEOUT_S)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+            proc.wait()
+            raise RuntimeError("PDF conversion timed out (LibreOffice headless).")
     if proc.returncode != 0:
         raise RuntimeError(f"PDF conversion failed (LibreOffice exit code: {proc.returncode}).")
     pdf_path = out_dir / (docx_path.stem + ".pdf")
@@ -93,6 +105,25 @@ def _run_soffice_convert_to_pdf(docx_path: Path, out_dir: Path) -> Path:
     return pdf_path
 
 
+def _export_pdf_with_worker(
+    docx_path: Path, out_dir: Path, *, update_fields: bool, port: int | None, attach: bool
+) -> Path:
+    # Same office (and loaded document) for the field refresh and the export; with `attach` the
+    # office of `lo_worker.py serve` is reused instead of cold-starting one.
+    out_dir.mkdir(parents=True, exist_ok=True)
+    pdf_path = out_dir / (docx_path.stem + ".pdf")
+    with OfficeWorker(port=port, attach=attach, call_timeout_s=PDF_TIMEOUT_S) as worker:
+        print(worker.describe_ready())
+        doc = worker.load(docx_path)
+        try:
+            if update_fields:
+                worker.refresh(doc)
+            worker.export_pdf(doc, pdf_path)
+        finally:
+            worker.close_doc(doc)
+    return pdf_path
+
+
 def _iter_vp_diagrams(diagrams_dir: Path) -> list[Path]:
     if not diagrams_dir.exists():
         return []
@@ -108,13 +139,35 @@ def _fig_id_from_filename(path: Path) -> str | None:
     return m.group(1) if m else None
 
 
-def _zip_dir(src_dir: Path, zip_path: Path) -> None:
+# Images and PDFs may be stored rather than deflated, but only when a trial deflate of their first
+# 64 KB shows they barely shrink (some PNGs here still lose 5-15% to deflate).
+_STORED_SUFFIXES = {".png", ".jpg", ".jpeg", ".gif", ".pdf", ".zip"}
+_MIN_DEFLATE_SAVING = 0.02
+_DEFLATE_SAMPLE_BYTES = 64 * 1024
+
+
+def _compress_type(path: Path, compresslevel: int | None) -> int:
+    if path.suffix.lower() not in _STORED_SUFFIXES:
+        return zipfile.ZIP_DEFLATED
+    with path.open("rb") as fh:
+        sample = fh.read(_DEFLATE_SAMPLE_BYTES)
+    deflated = len(zlib.compress(sample, -1 if compresslevel is None else compresslevel))
+    return zipfile.ZIP_STORED if sample and deflated > len(sample) * (1 - _MIN_DEFLATE_SAVING) else zipfile.ZIP_DEFLATED
+
+
+def _zip_dir(src_dir: Path, zip_path: Path, *, compresslevel: int | None = None) -> None:
     zip_path.parent.mkdir(parents=True, exist_ok=True)
-    with zipfile.ZipFile(zip_path, "w", compression=zipfile.ZIP_DEFLATED) as z:
+    prev_size = zip_path.stat().st_size if zip_path.exists() else None
+    t0 = time.perf_counter()
+    with zipfile.ZipFile(zip_path, "w", compression=zipfile.ZIP_DEFLATED, compresslevel=compresslevel) as z:
         for p in sorted(src_dir.rglob("*")):
             if p.is_dir():
                 continue
-            z.write(p, arcname=str(p.relative_to(src_dir)))
+            z.write(p, arcname=str(p.relative_to(src_dir)), compress_type=_compress_type(p, compresslevel))
+    elapsed = time.perf_counter() - t0
+    size = zip_path.stat().st_size
+    delta = f", {(size - prev_size) / 1024:+.1f} KB vs previous" if prev_size is not None else ""
+    print(f"Zip: {size / 1024:.1f} KB in {elapsed:.2f}s{delta}")
 
 
 def main() -> int:
@@ -135,6 +188,27 @@ def main() -> int:
     )
     parser.add_argument("--out-dir", type=Path, default=Path("dist/phase2"), help="Staging output directory")
     parser.add_argument("--zip", type=Path, default=Path("dist/phase2.zip"), help="Zip path")
+    parser.add_argument(
+        "--zip-level",
+        type=int,
+        choices=range(10),
+        default=None,
+        metavar="0-9",
+        help="Deflate level (0-9); PDF/images that barely compress are stored instead",
+    )
+    parser.add_argument(
+        "--update-fields",
+        action="store_true",
+        help="Refresh TOC/fields before exporting the PDF (same LibreOffice session; needs Python UNO)",
+    )
+    parser.add_argument(
+        "--lo-port", type=int, default=None, help="UNO port of the LibreOffice worker (default: a free one)"
+    )
+    parser.add_argument(
+        "--attach",
+        action="store_true",
+        help="Use the office of lo_worker.py serve (or the one on --lo-port) instead of starting one",
+    )
     args = parser.parse_args()
 
     docx_path: Path = args.docx
@@ -155,7 +229,17 @@ def main() -> int:
 
     with tempfile.TemporaryDirectory(prefix="sad-phase2-") as tmp:
         tmp_dir = Path(tmp)
-        pdf_path = _run_soffice_convert_to_pdf(docx_path, tmp_dir)
+        if not (args.update_fields or args.attach):
+            pdf_path = _run_soffice_convert_to_pdf(docx_path, tmp_dir)
+        elif OfficeWorker is None:
+            print(
+                "--update-fields/--attach need LibreOffice's Python UNO bindings (import uno failed)", file=sys.stderr
+            )
+            return 4
+        else:
+            pdf_path = _export_pdf_with_worker(
+                docx_path, tmp_dir, update_fields=args.update_fields, port=args.lo_port, attach=args.attach
+            )
         pdf_out_name = f"{args.student1}_{args.student2}_{_sanitize_filename(args.doc_title)}.pdf"
         shutil.copy2(pdf_path, out_dir / pdf_out_name)
 
@@ -167,7 +251,7 @@ def main() -> int:
         out_name = f"{args.student1}_{args.student2}_{title}{p.suffix.lower()}"
         shutil.copy2(p, out_dir / out_name)
 
-    _zip_dir(out_dir, args.zip)
+    _zip_dir(out_dir, args.zip, compresslevel=args.zip_level)
     print(f"Wrote folder: {out_dir}")
     print(f"Wrote zip: {args.zip}")
     return 0
@@ -2,14 +2,24 @@
 from __future__ import annotations
 
 import argparse
+import base64
+import hashlib
 import html as html_lib
+import io
+import json
+import os
+import queue
+import select
 import shutil
 import subprocess
+import sys
 import tempfile
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
-from PIL import Image
+from PIL import Image, ImageChops
 
 
 def find_mermaid_js() -> Path:
@@ -35,33 +45,141 @@ def find_mermaid_js() -> Path:
     )
 
 
-def crop_whitespace(img: Image.Image, padding: int = 24) -> Image.Image:
-    rgb = img.convert("RGB")
-    bg = (255, 255, 255)
+def crop_whitespace(img: Image.Image, padding: int = 24, *, tolerance: int = 0) -> Image.Image:
+    """
+    Crop uniform white margins around the rendered diagram.
 
-    # Find bounding box of non-white pixels.
-    bbox = None
-    pix = rgb.load()
+    Pixels whose channels all lie within `tolerance` of white are treated as background, so
+    anti-aliased near-white fringes can be trimmed too (tolerance=0 keeps exact-white matching).
+    """
+    rgb = img.convert("RGB")
     w, h = rgb.size
-    x_min, y_min, x_max, y_max = w, h, 0, 0
-    found = False
-    for y in range(h):
-        for x in range(w):
-            if pix[x, y] != bg:
-                x_min = min(x_min, x)
-                y_min = min(y_min, y)
-                x_max = max(x_max, x)
-                y_max = max(y_max, y)
-                found = True
-    if not found:
+
+    # Per-channel distance from white, reduced to the max channel; PIL does this in C, so there is
+    # no per-pixel Python work even on full-size Chrome screenshots.
+    diff = ImageChops.difference(rgb, Image.new("RGB", rgb.size, (255, 255, 255)))
+    r, g, b = diff.split()
+    mask = ImageChops.lighter(ImageChops.lighter(r, g), b)
+    if tolerance > 0:
+        mask = mask.point(lambda v: 255 if v > tolerance else 0)
+
+    bbox = mask.getbbox()
+    if bbox is None:
         return img
 
+    x_min, y_min, x_end, y_end = bbox
     x_min = max(0, x_min - padding)
     y_min = max(0, y_min - padding)
-    x_max = min(w - 1, x_max + padding)
-    y_max = min(h - 1, y_max + padding)
-    bbox = (x_min, y_min, x_max + 1, y_max + 1)
-    return img.crop(bbox)
+    x_end = min(w, x_end + padding)
+    y_end = min(h, y_end + padding)
+    return img.crop((x_min, y_min, x_end, y_end))
+
+
+_CHROME_FLAGS = [
+    "--no-sandbox",
+    "--disable-gpu",
+    "--disable-dev-shm-usage",
+    "--no-first-run",
+    "--no-default-browser-check",
+    "--hide-scrollbars",
+    # Extra stability flags for flaky CI/sandbox environments.
+    "--disable-crash-reporter",
+    "--disable-breakpad",
+    "--disable-features=Translate,BackForwardCache",
+]
+
+_PAGE_STYLE = """
+      html, body {
+        margin: 0;
+        padding: 0;
+        background: #fff;
+      }
+      .wrap {
+        padding: 40px;
+      }
+      .mermaid {
+        font-family: DejaVu Sans, Arial, sans-serif;
+      }
+"""
+
+
+# zlib effort per profile: "fast" for local iteration, "max" (the historical default) for release.
+PNG_PROFILES: dict[str, dict] = {
+    "fast": {"compress_level": 1},
+    "default": {"compress_level": 6},
+    "max": {"compress_level": 9, "optimize": True},
+}
+
+
+def _to_palette(im: Image.Image, quantize: str) -> Image.Image:
+    if quantize == "off":
+        return im
+    colors = im.getcolors(256)
+    if colors is not None:
+        # Flat-colour diagram: an exact palette is lossless.
+        pal_img = Image.new("P", (1, 1))
+        flat: list[int] = []
+        for _, rgb in colors:
+            flat.extend(rgb)
+        pal_img.putpalette(flat + [0] * (768 - len(flat)))
+        return im.quantize(palette=pal_img, dither=Image.Dither.NONE)
+    if quantize == "lossy":
+        return im.quantize(colors=256, method=Image.Quantize.MEDIANCUT, dither=Image.Dither.NONE)
+    return im
+
+
+def encode_png(
+    im: Image.Image,
+    out_png: Path,
+    *,
+    profile: str = "max",
+    quantize: str = "off",
+    dpi: int | None = None,
+) -> str:
+    """
+    Write `im` as PNG using one of PNG_PROFILES and return a one-line size/time report.
+
+    quantize: "off", "auto" (palette only when the image has <= 256 colours, i.e. lossless)
+    or "lossy" (always reduce to a 256-colour palette).
+    """
+    prev_size = out_png.stat().st_size if out_png.exists() else None
+    t0 = time.perf_counter()
+    im = _to_palette(im.convert("RGB"), quantize)
+    params = dict(PNG_PROFILES[profile])
+    if dpi is not None:
+        params["dpi"] = (dpi, dpi)
+    out_png.parent.mkdir(parents=True, exist_ok=True)
+    im.save(out_png, format="PNG", **params)
+    elapsed = time.perf_counter() - t0
+
+    size = out_png.stat().st_size
+    mode = f"{profile}+palette" if im.mode == "P" else profile
+    report = f"{size / 1024:.1f} KB ({mode}), encoded in {elapsed:.2f}s"
+    if prev_size is not None:
+        report += f", {(prev_size - size) / 1024:+.1f} KB saved vs previous"
+    return report
+
+
+def _finish_png(
+    im: Image.Image,
+    out_png: Path,
+    *,
+    crop: bool = True,
+    crop_tolerance: int = 0,
+    profile: str = "max",
+    quantize: str = "off",
+) -> str:
+    im = im.convert("RGB")
+    if crop:
+        im = crop_whitespace(im, padding=28, tolerance=crop_tolerance)
+
+    # Ensure minimum width for readability.
+    if im.size[0] < 1600:
+        scale = 1600 / max(im.size[0], 1)
+        new_size = (1600, int(im.size[1] * scale))
+        im = im.resize(new_size, Image.Resampling.LANCZOS)
+
+    return encode_png(im, out_png, profile=profile, quantize=quantize)
 
 
 def render_one(
@@ -73,7 +191,10 @@ def render_one(
     width: int,
     height: int,
     time_budget_ms: int,
-) -> None:
+    crop_tolerance: int = 0,
+    png_profile: str = "max",
+    quantize: str = "off",
+) -> str:
     code = src.read_text(encoding="utf-8")
     # Mermaid code is placed into HTML; escape it so tokens like "<<interface>>" are not treated as tags.
     code_html = html_lib.escape(code)
@@ -83,19 +204,7 @@ def render_one(
   <head>
     <meta charset="utf-8" />
     <meta name="viewport" content="width=device-width, initial-scale=1" />
-    <style>
-      html, body {{
-        margin: 0;
-        padding: 0;
-        background: #fff;
-      }}
-      .wrap {{
-        padding: 40px;
-      }}
-      .mermaid {{
-        font-family: DejaVu Sans, Arial, sans-serif;
-      }}
-    </style>
+    <style>{_PAGE_STYLE}    </style>
   </head>
   <body>
     <div class="wrap">
@@ -115,8 +224,6 @@ def render_one(
 </html>
 """
 
-    out_png.parent.mkdir(parents=True, exist_ok=True)
-
     with tempfile.TemporaryDirectory(prefix="mermaid-render-") as td:
         td_path = Path(td)
         html_path = td_path / "diagram.html"
@@ -125,16 +232,9 @@ def render_one(
 
         base_cmd = [
             str(chrome),
-            "--no-sandbox",
-            "--disable-gpu",
-            "--disable-dev-shm-usage",
-            "--no-first-run",
-            "--no-default-browser-check",
-            "--hide-scrollbars",
-            # Extra stability flags for flaky CI/sandbox environments.
-            "--disable-crash-reporter",
-            "--disable-breakpad",
-            "--disable-features=Translate,BackForwardCache",
+            *_CHROME_FLAGS,
+            # Isolated profile so concurrent renders (--jobs) never share Chrome state.
+            f"--user-data-dir={td_path / 'profile'}",
             f"--window-size={width},{height}",
             f"--virtual-time-budget={time_budget_ms}",
             f"--screenshot={raw_png}",
@@ -160,25 +260,393 @@ def render_one(
             raise last_err
 
         with Image.open(raw_png) as im:
-            im = im.convert("RGB")
-            im = crop_whitespace(im, padding=28)
+            return _finish_png(im, out_png, crop_tolerance=crop_tolerance, profile=png_profile, quantize=quantize)
+
+
+_SESSION_HOST_HTML = """<!doctype html>
+<html>
+  <head>
+    <meta charset="utf-8" />
+    <style>{style}    </style>
+  </head>
+  <body>
+    <div class="wrap"><div id="out"></div></div>
+    <script src="{mermaid_uri}"></script>
+    <script>
+      mermaid.initialize({{
+        startOnLoad: false,
+        securityLevel: "strict",
+        theme: "default"
+      }});
+      window.__renderMermaid = async (code) => {{
+        const out = document.getElementById("out");
+        out.innerHTML = "";
+        const node = document.createElement("div");
+        node.className = "mermaid";
+        node.textContent = code;
+        out.appendChild(node);
+        // Mermaid >= 10 exposes an async run(); older bundles only have the synchronous init().
+        if (typeof mermaid.run === "function") {{
+          await mermaid.run({{ nodes: [node] }});
+        }} else {{
+          mermaid.init(undefined, node);
+        }}
+        await document.fonts.ready;
+        await new Promise((resolve) => requestAnimationFrame(() => requestAnimationFrame(resolve)));
+        return node.querySelector("svg") !== null;
+      }};
+      // Size the SVG to its own viewBox so it is neither squeezed to the viewport nor padded out.
+      window.__naturalSvgRect = () => {{
+        const svg = document.querySelector("#out svg");
+        const vb = svg.viewBox && svg.viewBox.baseVal;
+        if (vb && vb.width && vb.height) {{
+          svg.setAttribute("width", String(vb.width));
+          svg.setAttribute("height", String(vb.height));
+          svg.style.removeProperty("max-width");
+        }}
+        const r = svg.getBoundingClientRect();
+        return {{ x: r.left + window.scrollX, y: r.top + window.scrollY, width: r.width, height: r.height }};
+      }};
+      window.__exportSvg = () => {{
+        const svg = document.querySelector("#out svg");
+        return new XMLSerializer().serializeToString(svg);
+      }};
+    </script>
+  </body>
+</html>
+"""
+
+
+class ChromeSession:
+    """
+    A single headless Chrome driven over the DevTools protocol (--remote-debugging-pipe).
+
+    Mermaid is loaded once into one page and every diagram is rendered through it; completion is
+    signalled by the page itself once the SVG is in the DOM, instead of a fixed virtual-time budget.
+    """
 
-            # Ensure minimum width for readability.
-            if im.size[0] < 1600:
-                scale = 1600 / max(im.size[0], 1)
-                new_size = (1600, int(im.size[1] * scale))
-                im = im.resize(new_size, Image.Resampling.LANCZOS)
+    def __init__(self, *, chrome: Path, mermaid_js: Path, width: int, height: int, timeout_s: float = 60.0) -> None:
+        self.chrome = chrome
+        self.mermaid_js = mermaid_js
+        self.width = width
+        self.height = height
+        self.timeout_s = timeout_s
+        self._proc: subprocess.Popen | None = None
+        self._tmp: tempfile.TemporaryDirectory | None = None
+        self._to_chrome = -1
+        self._from_chrome = -1
+        self._buf = b""
+        self._next_id = 0
+        self._events: list[dict] = []
+        self._session_id: str | None = None
 
-            im.save(out_png, format="PNG", optimize=True)
+    def __enter__(self) -> ChromeSession:
+        self.start()
+        return self
+
+    def __exit__(self, *exc: object) -> None:
+        self.close()
+
+    def start(self) -> None:
+        self._tmp = tempfile.TemporaryDirectory(prefix="mermaid-session-")
+        td_path = Path(self._tmp.name)
+        host_html = td_path / "host.html"
+        host_html.write_text(
+            _SESSION_HOST_HTML.format(style=_PAGE_STYLE, mermaid_uri=self.mermaid_js.as_uri()),
+            encoding="utf-8",
+        )
+
+        # Chrome can intermittently die with SIGTRAP in some sandboxes; try both headless modes.
+        last_err: Exception | None = None
+        for attempt, headless_flag in enumerate(("--headless=new", "--headless")):
+            try:
+                self._launch(headless_flag, profile_dir=td_path / f"profile-{attempt}")
+                self._open_page(host_html)
+                return
+            except Exception as e:
+                last_err = e
+                self._shutdown_process()
+        self.close()
+        raise RuntimeError(f"Could not start headless Chrome session (last error: {last_err})")
+
+    def restart(self) -> None:
+        self.close()
+        self.start()
+
+    def close(self) -> None:
+        if self._proc is not None:
+            try:
+                self._send("Browser.close", session=False, timeout_s=5.0)
+            except Exception:
+                pass
+        self._shutdown_process()
+        if self._tmp is not None:
+            self._tmp.cleanup()
+            self._tmp = None
+
+    def render_png(self, code: str, *, min_width: int = 1600, padding: int = 28) -> Image.Image:
+        """
+        Render a diagram and capture exactly its SVG bounding box (plus padding), so tall diagrams
+        are never clipped by the viewport and there is no white margin to crop afterwards.
+        Small diagrams are captured at a higher device scale instead of being upscaled later.
+        """
+        self._render(code)
+        rect = self._eval("window.__naturalSvgRect()")
+        clip = self._clip(rect, padding=padding)
+        clip["scale"] = max(1.0, min_width / max(clip["width"], 1.0))
+        return self._capture(clip)
+
+    def render_svg(self, code: str, *, dpi: int | None = None, padding: int = 28) -> tuple[str, Image.Image | None]:
+        """
+        Render a diagram and return its standalone SVG markup, plus (when `dpi` is given) a PNG
+        rasterized straight from the SVG at that DPI, captured by clip so no crop/upscale is needed.
+        """
+        self._render(code)
+        rect = self._eval("window.__naturalSvgRect()")
+        svg_text = self._eval("window.__exportSvg()")
+        if dpi is None:
+            return svg_text, None
+
+        clip = self._clip(rect, padding=padding)
+        # CSS pixels are 1/96 inch.
+        clip["scale"] = dpi / 96
+        return svg_text, self._capture(clip)
+
+    @staticmethod
+    def _clip(rect: dict, *, padding: int) -> dict:
+        x = max(0.0, rect["x"] - padding)
+        y = max(0.0, rect["y"] - padding)
+        return {
+            "x": x,
+            "y": y,
+            "width": rect["x"] + rect["width"] + padding - x,
+            "height": rect["y"] + rect["height"] + padding - y,
+        }
+
+    def _capture(self, clip: dict) -> Image.Image:
+        shot = self._send("Page.captureScreenshot", {"format": "png", "clip": clip, "captureBeyondViewport": True})
+        return Image.open(io.BytesIO(base64.b64decode(shot["data"])))
+
+    def _eval(self, expression: str) -> object:
+        res = self._send("Runtime.evaluate", {"expression": expression, "returnByValue": True})
+        if "exceptionDetails" in res:
+            raise RuntimeError(f"Page script failed: {res['exceptionDetails'].get('text', '')}")
+        return res.get("result", {}).get("value")
+
+    def _render(self, code: str) -> None:
+        res = self._send(
+            "Runtime.evaluate",
+            {
+                "expression": f"window.__renderMermaid({json.dumps(code)})",
+                "awaitPromise": True,
+                "returnByValue": True,
+            },
+        )
+        if "exceptionDetails" in res:
+            details = res["exceptionDetails"]
+            msg = details.get("exception", {}).get("description") or details.get("text", "")
+            raise RuntimeError(f"Mermaid render failed: {msg}")
+        if not res.get("result", {}).get("value"):
+            raise RuntimeError("Mermaid render produced no SVG")
+
+    def _launch(self, headless_flag: str, *, profile_dir: Path) -> None:
+        # fd 3 is what Chrome reads commands from, fd 4 is where it writes replies/events.
+        child_in, self._to_chrome = os.pipe()
+        self._from_chrome, child_out = os.pipe()
+        cmd = [
+            str(self.chrome),
+            headless_flag,
+            *_CHROME_FLAGS,
+            "--remote-debugging-pipe",
+            f"--user-data-dir={profile_dir}",
+            f"--window-size={self.width},{self.height}",
+            "about:blank",
+        ]
+        try:
+            # subprocess can't place an fd at a chosen number without preexec_fn (unsafe while other
+            # threads run), so hand the pipe ends over as stdin/stdout and let a shell move them to
+            # 3/4 before exec'ing Chrome. Single-digit fds keep this working in any POSIX sh.
+            self._proc = subprocess.Popen(
+                ["/bin/sh", "-c", 'exec "$0" "$@" 3<&0 4>&1 0</dev/null 1>/dev/null', *cmd],
+                stdin=child_in,
+                stdout=child_out,
+                stderr=subprocess.DEVNULL,
+            )
+        finally:
+            os.close(child_in)
+            os.close(child_out)
+        self._send("Browser.getVersion", session=False)
+
+    def _open_page(self, host_html: Path) -> None:
+        target = self._send("Target.createTarget", {"url": "about:blank"}, session=False)
+        attached = self._send(
+            "Target.attachToTarget", {"targetId": target["targetId"], "flatten": True}, session=False
+        )
+        self._session_id = attached["sessionId"]
+        self._send("Page.enable")
+        self._send("Runtime.enable")
+        self._send(
+            "Emulation.setDeviceMetricsOverride",
+            {"width": self.width, "height": self.height, "deviceScaleFactor": 1, "mobile": False},
+        )
+        self._events.clear()
+        self._send("Page.navigate", {"url": host_html.as_uri()})
+        self._wait_event("Page.loadEventFired")
+
+    def _shutdown_process(self) -> None:
+        for fd in (self._to_chrome, self._from_chrome):
+            if fd >= 0:
+                try:
+                    os.close(fd)
+                except OSError:
+                    pass
+        self._to_chrome = self._from_chrome = -1
+        self._buf = b""
+        self._events.clear()
+        self._session_id = None
+        if self._proc is not None:
+            try:
+                self._proc.wait(timeout=5)
+            except subprocess.TimeoutExpired:
+                self._proc.kill()
+                self._proc.wait()
+            self._proc = None
+
+    def _send(
+        self, method: str, params: dict | None = None, *, session: bool = True, timeout_s: float | None = None
+    ) -> dict:
+        self._next_id += 1
+        msg_id = self._next_id
+        msg: dict = {"id": msg_id, "method": method, "params": params or {}}
+        if session and self._session_id:
+            msg["sessionId"] = self._session_id
+        os.write(self._to_chrome, json.dumps(msg).encode("utf-8") + b"\0")
+
+        deadline = time.monotonic() + (self.timeout_s if timeout_s is None else timeout_s)
+        while True:
+            reply = self._read_message(deadline)
+            if reply.get("id") == msg_id:
+                if "error" in reply:
+                    raise RuntimeError(f"{method} failed: {reply['error'].get('message')}")
+                return reply.get("result", {})
+            if "method" in reply:
+                self._events.append(reply)
+
+    def _wait_event(self, method: str) -> dict:
+        deadline = time.monotonic() + self.timeout_s
+        while True:
+            for i, ev in enumerate(self._events):
+                if ev.get("method") == method:
+                    return self._events.pop(i)
+            reply = self._read_message(deadline)
+            if "method" in reply:
+                self._events.append(reply)
+
+    def _read_message(self, deadline: float) -> dict:
+        while b"\0" not in self._buf:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise TimeoutError("Timed out waiting for Chrome DevTools reply")
+            ready, _, _ = select.select([self._from_chrome], [], [], remaining)
+            if not ready:
+                continue
+            chunk = os.read(self._from_chrome, 1 << 16)
+            if not chunk:
+                raise RuntimeError("Chrome exited unexpectedly")
+            self._buf += chunk
+        raw, self._buf = self._buf.split(b"\0", 1)
+        return json.loads(raw)
+
+
+RENDER_MANIFEST_NAME = ".mermaid-render-cache.json"
+# 1600px across the 6.5in text width generate_sad_final_docx.py caps figures at.
+DEFAULT_RASTER_DPI = 246
+
+
+def _sha256_file(path: Path) -> str:
+    h = hashlib.sha256()
+    with path.open("rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def _render_key(code: str, *, settings: dict, mermaid_hash: str) -> str:
+    # Anything that can change the output pixels must be part of the key.
+    payload = json.dumps({"code": code, "settings": settings, "mermaid": mermaid_hash}, sort_keys=True)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def _load_manifest(path: Path) -> dict[str, dict]:
+    try:
+        data = json.loads(path.read_text(encoding="utf-8"))
+    except (OSError, ValueError):
+        return {}
+    entries = data.get("entries") if isinstance(data, dict) else None
+    return entries if isinstance(entries, dict) else {}
+
+
+def _save_manifest(path: Path, entries: dict[str, dict]) -> None:
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_suffix(path.suffix + ".tmp")
+    tmp.write_text(json.dumps({"version": 1, "entries": entries}, indent=2, sort_keys=True) + "\n", encoding="utf-8")
+    tmp.replace(path)
 
 
 def main() -> int:
     parser = argparse.ArgumentParser()
     parser.add_argument("--src-dir", default="diagrams/mermaid", help="Folder containing .mmd files")
     parser.add_argument("--out-dir", default="diagrams", help="Output folder for .png files")
-    parser.add_argument("--width", type=int, default=2200, help="Chrome viewport width")
-    parser.add_argument("--height", type=int, default=2000, help="Chrome viewport height")
+    parser.add_argument(
+        "--width", type=int, default=2200, help="Chrome viewport width (per-file mode captures this whole viewport)"
+    )
+    parser.add_argument(
+        "--height", type=int, default=2000, help="Chrome viewport height (session modes capture the SVG bbox instead)"
+    )
     parser.add_argument("--time-budget-ms", type=int, default=5000, help="Time budget to let Mermaid render")
+    parser.add_argument(
+        "--crop-tolerance",
+        type=int,
+        default=0,
+        help="Treat pixels within this distance of white (0-255) as background when cropping",
+    )
+    parser.add_argument(
+        "--batch",
+        action="store_true",
+        help="Render all diagrams through one persistent Chrome session (DevTools protocol)",
+    )
+    parser.add_argument("--timeout-s", type=float, default=60.0, help="Per-diagram timeout in --batch mode")
+    parser.add_argument(
+        "--jobs",
+        type=int,
+        default=1,
+        help="Render this many diagrams concurrently (with --batch: this many Chrome sessions)",
+    )
+    parser.add_argument(
+        "--format",
+        choices=("png", "svg", "svg+png"),
+        default="png",
+        help="png: screenshot pipeline; svg: extract the rendered SVG only; svg+png: SVG plus a PNG rasterized from it",
+    )
+    parser.add_argument(
+        "--dpi",
+        type=int,
+        default=None,
+        help="Rasterize PNGs from the SVG at this DPI (no crop/upscale); uses a Chrome session like --batch",
+    )
+    parser.add_argument(
+        "--png-profile",
+        choices=sorted(PNG_PROFILES),
+        default="max",
+        help="PNG encoder effort: fast (iteration), default, max (release; previous behaviour)",
+    )
+    parser.add_argument(
+        "--quantize",
+        choices=("off", "auto", "lossy"),
+        default="off",
+        help="Palette PNGs: auto = only when lossless (<= 256 colours), lossy = always 256 colours",
+    )
+    parser.add_argument("--force", action="store_true", help="Re-render even if the render cache says unchanged")
     args = parser.parse_args()
 
     chrome = shutil.which("google-chrome") or shutil.which("chromium") or shutil.which("chromium-browser")
@@ -196,19 +664,159 @@ def main() -> int:
     if not mmd_files:
         raise SystemExit(f"هیچ فایل .mmd در این مسیر نیست: {src_dir}")
 
+    if args.format == "svg+png" and args.dpi is None:
+        args.dpi = DEFAULT_RASTER_DPI
+    # SVG extraction and DPI rasterization both need the DevTools session.
+    use_session = args.batch or args.format != "png" or args.dpi is not None
+
+    def _outputs(src: Path) -> list[Path]:
+        outs: list[Path] = []
+        if args.format in ("svg", "svg+png"):
+            outs.append(out_dir / (src.stem + ".svg"))
+        if args.format in ("png", "svg+png"):
+            outs.append(out_dir / (src.stem + ".png"))
+        return outs
+
+    # Skip diagrams whose source, render settings and mermaid.js are unchanged since the last run.
+    manifest_path = out_dir / RENDER_MANIFEST_NAME
+    manifest = _load_manifest(manifest_path)
+    mermaid_hash = _sha256_file(mermaid_js)
+    settings = {
+        "width": args.width,
+        "height": args.height,
+        "crop_tolerance": args.crop_tolerance,
+        "batch": use_session,
+        "capture": "svg-clip" if use_session else "viewport",
+        "time_budget_ms": None if use_session else args.time_budget_ms,
+        "format": args.format,
+        "dpi": args.dpi,
+        "png_profile": args.png_profile,
+        "quantize": args.quantize,
+    }
+    keys: dict[Path, str] = {}
+    to_render: list[Path] = []
     for src in mmd_files:
+        keys[src] = _render_key(src.read_text(encoding="utf-8"), settings=settings, mermaid_hash=mermaid_hash)
+        entry = manifest.get(src.name) or {}
+        if not args.force and entry.get("key") == keys[src] and all(p.exists() for p in _outputs(src)):
+            print(f"SKIP: {src.name} (unchanged)")
+            continue
+        to_render.append(src)
+
+    if not to_render:
+        return 0
+
+    # None in the queue means every session has died; it is put back for the next waiting worker.
+    sessions: queue.Queue[ChromeSession | None] | None = queue.Queue() if use_session else None
+    live_sessions = 0
+    live_lock = threading.Lock()
+
+    def _drop_session(session: ChromeSession) -> None:
+        nonlocal live_sessions
+        session.close()
+        with live_lock:
+            live_sessions -= 1
+            if live_sessions == 0:
+                sessions.put(None)
+
+    def _render_file(src: Path) -> tuple[float, str]:
+        t0 = time.perf_counter()
         out_png = out_dir / (src.stem + ".png")
-        render_one(
-            chrome=Path(chrome),
-            mermaid_js=mermaid_js,
-            src=src,
-            out_png=out_png,
-            width=args.width,
-            height=args.height,
-            time_budget_ms=args.time_budget_ms,
-        )
-        print(f"OK: {src.name} -> {out_png}")
+        report = ""
+        if sessions is not None:
+            session = sessions.get()
+            if session is None:
+                sessions.put(None)
+                raise RuntimeError("no working Chrome session left")
+            try:
+                try:
+                    code = src.read_text(encoding="utf-8")
+                    if args.format == "png" and args.dpi is None:
+                        with session.render_png(code) as im:
+                            # Already clipped to the SVG bounding box.
+                            report = _finish_png(
+                                im, out_png, crop=False, profile=args.png_profile, quantize=args.quantize
+                            )
+                    else:
+                        svg_text, raster = session.render_svg(code, dpi=None if args.format == "svg" else args.dpi)
+                        if args.format != "png":
+                            out_dir.mkdir(parents=True, exist_ok=True)
+                            (out_dir / (src.stem + ".svg")).write_text(svg_text, encoding="utf-8")
+                        if raster is not None and args.format != "svg":
+                            with raster:
+                                report = encode_png(
+                                    raster, out_png, profile=args.png_profile, quantize=args.quantize, dpi=args.dpi
+                                )
+                except Exception:
+                    # Don't let one broken diagram/browser poison the rest of the batch.
+                    try:
+                        session.restart()
+                    except Exception as restart_err:
+                        print(f"WARN: Chrome session could not be restarted: {restart_err}", file=sys.stderr)
+                        _drop_session(session)
+                        session = None
+                    raise
+            finally:
+                if session is not None:
+                    sessions.put(session)
+        else:
+            report = render_one(
+                chrome=Path(chrome),
+                mermaid_js=mermaid_js,
+                src=src,
+                out_png=out_png,
+                width=args.width,
+                height=args.height,
+                time_budget_ms=args.time_budget_ms,
+                crop_tolerance=args.crop_tolerance,
+                png_profile=args.png_profile,
+                quantize=args.quantize,
+            )
+        return time.perf_counter() - t0, report
+
+    failed = 0
+    try:
+        if sessions is not None:
+            # Sessions are started up front on the main thread; workers borrow one per diagram.
+            for _ in range(max(1, min(args.jobs, len(to_render)))):
+                session = ChromeSession(
+                    chrome=Path(chrome),
+                    mermaid_js=mermaid_js,
+                    width=args.width,
+                    height=args.height,
+                    timeout_s=args.timeout_s,
+                )
+                session.start()
+                sessions.put(session)
+                live_sessions += 1
+
+        with ThreadPoolExecutor(max_workers=max(1, args.jobs)) as pool:
+            futures = [(src, pool.submit(_render_file, src)) for src in to_render]
+            # Report in input order regardless of completion order.
+            for src, fut in futures:
+                try:
+                    elapsed, report = fut.result()
+                except Exception as e:
+                    failed += 1
+                    manifest.pop(src.name, None)
+                    print(f"FAIL: {src.name}: {e}", file=sys.stderr)
+                    continue
+                outs = _outputs(src)
+                manifest[src.name] = {"key": keys[src], "outputs": [p.name for p in outs]}
+                print(f"OK: {src.name} -> {', '.join(str(p) for p in outs)} ({elapsed:.2f}s)")
+                if report:
+                    print(f"    png: {report}")
+    finally:
+        if sessions is not None:
+            while not sessions.empty():
+                session = sessions.get()
+                if session is not None:
+                    session.close()
+        _save_manifest(manifest_path, manifest)
 
+    if failed:
+        print(f"{failed} of {len(to_render)} diagrams failed", file=sys.stderr)
+        return 1
     return 0
 
 
@@ -2,129 +2,123 @@
 from __future__ import annotations
 
 import argparse
-import subprocess
+import glob
 import sys
 import time
 from pathlib import Path
 
-import uno
+from lo_worker import OfficeWorker
 
 
-def _prop(name: str, value) -> object:
-    p = uno.createUnoStruct("com.sun.star.beans.PropertyValue")
-    p.Name = name
-    p.Value = value
-    return p
-
-
-def _connect_desktop(host: str, port: int, *, timeout_s: float) -> object:
-    local_ctx = uno.getComponentContext()
-    resolver = local_ctx.ServiceManager.createInstanceWithContext("com.sun.star.bridge.UnoUrlResolver", local_ctx)
-    deadline = time.time() + timeout_s
-    last_err: Exception | None = None
-    while time.time() < deadline:
-        try:
-            ctx = resolver.resolve(f"uno:socket,host={host},port={port};urp;StarOffice.ComponentContext")
-            smgr = ctx.ServiceManager
-            desktop = smgr.createInstanceWithContext("com.sun.star.frame.Desktop", ctx)
-            return desktop
-        except Exception as e:  # pragma: no cover
-            last_err = e
-            time.sleep(0.2)
-    raise RuntimeError(f"Failed to connect to LibreOffice UNO (last error: {last_err})")
-
-
-def _file_url(path: Path) -> str:
-    return path.resolve().as_uri()
+def _update_one(worker: OfficeWorker, in_path: Path, out_path: Path, pdf_path: Path | None) -> dict[str, float]:
+    timings: dict[str, float] = {}
+    t0 = time.perf_counter()
+    doc = worker.load(in_path)
+    timings["load"] = time.perf_counter() - t0
+    try:
+        t0 = time.perf_counter()
+        worker.refresh(doc)
+        timings["refresh"] = time.perf_counter() - t0
+        t0 = time.perf_counter()
+        worker.store_docx(doc, out_path)
+        timings["store"] = time.perf_counter() - t0
+        if pdf_path is not None:
+            t0 = time.perf_counter()
+            worker.export_pdf(doc, pdf_path)
+            timings["pdf"] = time.perf_counter() - t0
+    finally:
+        worker.close_doc(doc)
+    return timings
 
 
 def main() -> int:
-    parser = argparse.ArgumentParser(description="Update TOC/fields in a DOCX using LibreOffice headless (UNO).")
-    parser.add_argument("input", type=Path, help="Input .docx")
-    parser.add_argument("--output", type=Path, default=None, help="Output .docx (default: overwrite input)")
+    parser = argparse.ArgumentParser(
+        description=(
+            "Update TOC/fields in one or more DOCX files using LibreOffice headless (UNO). "
+            "All documents go through a single office process and Desktop connection."
+        )
+    )
+    parser.add_argument("inputs", type=Path, nargs="*", help="Input .docx files")
+    parser.add_argument(
+        "--glob", action="append", default=[], help="Also process files matching this pattern (repeatable)"
+    )
+    parser.add_argument(
+        "--output", type=Path, default=None, help="Output .docx (single input only; default: overwrite input)"
+    )
+    parser.add_argument(
+        "--pdf",
+        type=Path,
+        default=None,
+        help="Also export a PDF from the same loaded (refreshed) document (single input only)",
+    )
+    parser.add_argument("--pdf-dir", type=Path, default=None, help="Export <name>.pdf for every input into this dir")
     parser.add_argument("--host", default="127.0.0.1")
-    parser.add_argument("--port", type=int, default=2002)
+    parser.add_argument(
+        "--port", type=int, default=None, help="UNO port (default: a free one for our own office)"
+    )
+    parser.add_argument(
+        "--attach",
+        action="store_true",
+        help="Use an office already listening on --port (default: the one advertised by lo_worker.py serve)",
+    )
     parser.add_argument("--timeout-s", type=float, default=20.0)
+    parser.add_argument(
+        "--call-timeout-s",
+        type=float,
+        default=60.0,
+        help="Per-document bound for each load/refresh/store/export; a hung office is killed and restarted",
+    )
     args = parser.parse_args()
 
-    in_path: Path = args.input
-    out_path: Path = args.output or in_path
-    if not in_path.exists():
-        print(f"Missing input: {in_path}", file=sys.stderr)
+    in_paths: list[Path] = list(args.inputs)
+    for pattern in args.glob:
+        in_paths.extend(Path(p) for p in sorted(glob.glob(pattern)))
+    # Keep order, drop duplicates (an explicit path may also match a glob).
+    in_paths = list(dict.fromkeys(p.resolve() for p in in_paths))
+    if not in_paths:
+        parser.error("no input documents (give paths and/or --glob)")
+    if len(in_paths) > 1 and (args.output is not None or args.pdf is not None):
+        parser.error("--output/--pdf take a single input; use --pdf-dir for several")
+    missing = [p for p in in_paths if not p.exists()]
+    if missing:
+        print(f"Missing input: {', '.join(str(p) for p in missing)}", file=sys.stderr)
         return 2
+    if args.pdf_dir is not None:
+        args.pdf_dir.mkdir(parents=True, exist_ok=True)
 
-    profile_dir = Path("/tmp") / f"lo-profile-{int(time.time())}"
-    profile_dir.mkdir(parents=True, exist_ok=True)
-    profile_url = profile_dir.resolve().as_uri()
-
-    cmd = [
-        "soffice",
-        "--headless",
-        "--nologo",
-        "--nolockcheck",
-        "--nodefault",
-        "--norestore",
-        "--invisible",
-        f'--accept=socket,host={args.host},port={args.port};urp;',
-        f"-env:UserInstallation={profile_url}",
-    ]
-
-    proc = subprocess.Popen(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    worker = OfficeWorker(
+        host=args.host, port=args.port, attach=args.attach, timeout_s=args.timeout_s, call_timeout_s=args.call_timeout_s
+    )
     try:
-        desktop = _connect_desktop(args.host, args.port, timeout_s=args.timeout_s)
-
-        load_props = (
-            _prop("Hidden", True),
-            _prop("ReadOnly", False),
-            # Make the importer explicit; in some environments LO may not auto-detect .docx reliably via UNO.
-            _prop("FilterName", "MS Word 2007 XML"),
-        )
-        doc = None
-        for _ in range(15):
+        worker.start()
+    except RuntimeError as e:
+        print(str(e), file=sys.stderr)
+        return 3
+    print(worker.describe_ready())
+
+    failed: list[Path] = []
+    t_all = time.perf_counter()
+    try:
+        for in_path in in_paths:
+            out_path = args.output or in_path
+            pdf_path = args.pdf or (args.pdf_dir / (in_path.stem + ".pdf") if args.pdf_dir is not None else None)
             try:
-                doc = desktop.loadComponentFromURL(_file_url(in_path), "_blank", 0, load_props)
-            except Exception:
-                doc = None
-            if doc is not None:
-                break
-            time.sleep(0.2)
-        if doc is None:
-            print("Failed to load document via UNO (doc is None).", file=sys.stderr)
-            return 3
-
-        # Update indexes (TOC is an index) and fields.
-        try:
-            indexes = doc.getDocumentIndexes()
-            for i in range(indexes.getCount()):
-                indexes.getByIndex(i).update()
-        except Exception:
-            pass
-        try:
-            doc.refresh()
-        except Exception:
-            pass
-        try:
-            doc.getTextFields().refresh()
-        except Exception:
-            pass
+                timings = _update_one(worker, in_path, out_path, pdf_path)
+            except Exception as e:
+                failed.append(in_path)
+                print(f"{in_path.name}: FAILED ({e})", file=sys.stderr)
+                continue
+            detail = ", ".join(f"{k} {v:.2f}s" for k, v in timings.items())
+            print(f"{in_path.name}: {sum(timings.values()):.2f}s ({detail})")
+    finally:
+        worker.close()
 
-        store_props = (
-            _prop("FilterName", "MS Word 2007 XML"),
-            _prop("Overwrite", True),
+    if len(in_paths) > 1:
+        print(
+            f"Updated {len(in_paths) - len(failed)}/{len(in_paths)} document(s) in {time.perf_counter() - t_all:.2f}s"
+            + (f", {worker.restarts} office restart(s)" if worker.restarts else "")
         )
-        doc.storeToURL(_file_url(out_path), store_props)
-        doc.close(True)
-        try:
-            desktop.terminate()
-        except Exception:
-            pass
-    finally:
-        proc.terminate()
-        try:
-            proc.wait(timeout=5)
-        except Exception:
-            proc.kill()
-    return 0
+    return 3 if failed else 0
 
 
 if __name__ == "__main__":